@@ -71,6 +71,8 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'brickly.wsgi.application'
 
+ASGI_APPLICATION = 'brickly.asgi.application'
+
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
@@ -135,3 +137,111 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Website / account emails
+
+WEBSITE = {
+    'url': 'http://127.0.0.1:8000/',
+    'support_url': 'http://127.0.0.1:8000/support/',
+    'support_email': 'support@brickly.local',
+    'confirmation_digits': 4,
+    'confirmation_timeout': 60 * 30,
+}
+
+# Outbound emails are written to the outbox table by the views and delivered
+# by `manage.py run_outbox_workers`.
+EMAIL_OUTBOX = {
+    'workers': 4,
+    'batch_size': 50,
+    'poll_interval': 1.0,
+    'lease_secs': 300,
+    'max_attempts': 5,
+    'backoff_secs': 30,
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Per-user serialized email lists (see myapp.caching). An alias missing from
+# CACHES falls back to a process-local cache. Invalidation only reaches the
+# cache it is made in, so with more than one worker process the alias must
+# name a shared backend (Redis, Memcached); otherwise the other workers serve
+# stale lists for up to timeout seconds. `manage.py check --deploy` warns.
+EMAIL_LIST_CACHE = {
+    'alias': 'default',
+    'timeout': 300,
+}
+
+# Worker start-up (see brickly/wsgi.py and myapp.startup). With warmup on, the
+# WSGI module loads what the first request would otherwise load; confirmation
+# templates are compiled for the given languages (empty: LANGUAGE_CODE only).
+# `manage.py startup_report` prints where start-up time goes.
+STARTUP = {
+    'warmup': True,
+    'languages': [],
+}
+
+# Per-user primary emails for EmailManager.get_primary_for_users (see
+# myapp.caching). An alias of None turns the cache off.
+PRIMARY_EMAIL_CACHE = {
+    'alias': None,
+    'timeout': 300,
+}
+
+# Response rendering for myapp.ownView.RestView. json_backend is 'stdlib'
+# (byte-compatible output) or 'orjson' (faster, compact output; falls back to
+# stdlib when orjson is not installed). List results with at least
+# stream_threshold items are sent as a streaming response. Token-bucket
+# throttle state lives in the throttle_cache alias (process-local if missing).
+REST_VIEW = {
+    'json_backend': 'stdlib',
+    'stream_threshold': 1000,
+    'throttle_cache': 'default',
+}
+
+# Signed API tokens for RestView (myapp.tokens): seconds each purpose's tokens
+# stay valid, and the process-local cache of users behind verified tokens.
+API_TOKENS = {
+    'max_age': {
+        'api': 24 * 3600,
+        'email_confirm': 30 * 60,
+    },
+    'user_cache_size': 1024,
+    'user_cache_timeout': 60,
+}
+
+# Read replicas: aliases from DATABASES that serve reads of read-only RestView
+# GET handlers (myapp.routers.ReplicaRouter). After a write, the user's reads
+# stay on the primary for sticky_secs; pins are kept in the given cache alias.
+DATABASE_ROUTERS = ['myapp.routers.ReplicaRouter']
+
+READ_REPLICAS = {
+    'databases': [],
+    'sticky_secs': 5,
+    'cache': 'default',
+}
+
+# Per-endpoint metrics for RestView (myapp.metrics): latency, query count and
+# time, and response size by view and status. Served in the Prometheus text
+# format at /myapp/metrics/ to the addresses in allowed_ips.
+METRICS = {
+    'enabled': True,
+    'allowed_ips': ['127.0.0.1', '::1'],
+}
+
+# Query budgets (myapp.budgets): RestView subclasses and manager methods declare
+# the most queries they may make. Going over logs a warning with the SQL when
+# DEBUG is on; the test runner sets 'raise' so that it fails the test instead.
+QUERY_BUDGETS = {
+    'raise': False,
+}
+
+TEST_RUNNER = 'myapp.testing.TestRunner'
@@ -0,0 +1,38 @@
+"""
+Settings for running ``manage.py benchmark`` offline, on SQLite instead of MySQL:
+
+    python manage.py benchmark endpoints --settings=brickly.settings_benchmark
+    python manage.py benchmark endpoints --settings=brickly.settings_benchmark --save baseline.json
+    python manage.py benchmark endpoints --settings=brickly.settings_benchmark --compare baseline.json
+
+Suites always run against the throwaway test database, which is a file so that
+threaded suites share it.
+
+Also the settings for running the test suite without MySQL:
+
+    python manage.py test myapp --settings=brickly.settings_benchmark
+
+The 'replica' alias mirrors the test database, so the read-replica routing tests
+run; READ_REPLICAS leaves it unused otherwise.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'benchmark.sqlite3'),  # noqa: F405
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'benchmark_test.sqlite3'),  # noqa: F405
+        },
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'benchmark.sqlite3'),  # noqa: F405
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
+}
+
+SILENCED_SYSTEM_CHECKS = ['models.W042']
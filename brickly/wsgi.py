@@ -2,6 +2,9 @@
 WSGI config for brickly project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
+With STARTUP['warmup'] on, the URLconf, DRF settings and confirmation templates
+are loaded here, before the worker accepts traffic, rather than by its first
+request (see myapp.startup).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/2.0/howto/deployment/wsgi/
@@ -9,8 +12,14 @@ https://docs.djangoproject.com/en/2.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "brickly.settings")
 
 application = get_wsgi_application()
+
+if settings.STARTUP['warmup']:
+    from myapp.startup import warmup
+
+    warmup()
@@ -1,4 +1,4 @@
 from django.contrib import admin
-from .models import Email, EmailConfirmation
+from .models import Email, EmailConfirmation, OutboundEmail
 
-admin.site.register((Email, EmailConfirmation))
+admin.site.register((Email, EmailConfirmation, OutboundEmail))
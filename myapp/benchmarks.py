@@ -0,0 +1,593 @@
+"""Micro-benchmarks, run with ``manage.py benchmark [suite ...]``.
+
+Each suite is a function taking the command options and returning a list of
+result dicts with at least ``name`` and ``per_op_us``. Suites run against a
+throwaway test database, never the configured one.
+"""
+import asyncio
+import math
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import datetime
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.mail import send_mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import AsyncClient, Client, override_settings
+from django.urls import path
+from django.utils.http import urlencode
+from django.utils import timezone, translation
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_framework.utils.encoders import JSONEncoder
+
+from .datetime import Datetime
+from .emails import EmailRenderer
+from .encoders import EnvelopeEncoder, OrjsonBackend, StdlibJSONBackend, load_orjson
+from .mailer import OutboxWorker, enqueue_mail
+from .models import Email, EmailConfirmation, hash_confirmation_token
+from .ownView import AsyncRestView, BoolParam, DateParam, EmailParam, IntParam, RestView, StringParam
+from .serializers import EmailReadSerializer, EmailSerializer
+from .tokens import make_token
+
+suites = OrderedDict()
+
+
+def suite(name):
+    def register(func):
+        suites[name] = func
+        return func
+    return register
+
+
+def measure(func, number, repeat=3):
+    """Best-of-``repeat`` seconds per call of ``func`` over ``number`` calls."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(name, seconds, **extra):
+    row = {'name': name, 'per_op_us': seconds * 1e6}
+    row.update(extra)
+    return row
+
+
+def percentile(values, q):
+    """Nearest-rank ``q``-th percentile of an ascending list."""
+    return values[max(0, int(math.ceil(q / 100.0 * len(values))) - 1)]
+
+
+def latency_result(name, wall, latencies, **extra):
+    """Throughput and latency percentiles of ``latencies`` (seconds) served in ``wall`` seconds."""
+    latencies = sorted(latencies)
+    return result(name, wall / len(latencies), req_s=round(len(latencies) / wall, 1),
+                  p50_ms=round(percentile(latencies, 50) * 1e3, 2),
+                  p95_ms=round(percentile(latencies, 95) * 1e3, 2),
+                  p99_ms=round(percentile(latencies, 99) * 1e3, 2), **extra)
+
+
+def compare(baseline, current, threshold):
+    """Rows of ``current`` slower than in ``baseline`` by more than ``threshold`` (0.1 = 10%).
+
+    Both are ``{suite: [row, ...]}``; rows are matched by name and compared on
+    ``per_op_us`` and, where present, ``p95_ms``. Returns ``(suite, name, metric, old, new)``.
+    A row that failed (``error``) is a regression with metric 'error' and the message as
+    ``new``; so is a baseline metric that is missing or not finite now (``new`` None), and
+    a baseline row missing from a suite that was run (metric 'missing').
+    """
+    regressions = []
+    for suite_name, rows in current.items():
+        names = {row['name'] for row in rows}
+        for row in baseline.get(suite_name, ()):
+            if row['name'] not in names:
+                regressions.append((suite_name, row['name'], 'missing', None, None))
+        old_rows = {row['name']: row for row in baseline.get(suite_name, ())}
+        for row in rows:
+            if 'error' in row:
+                regressions.append((suite_name, row['name'], 'error', None, row['error']))
+                continue
+            old = old_rows.get(row['name'])
+            if old is None:
+                continue
+            for metric in ('per_op_us', 'p95_ms'):
+                if metric not in old:
+                    continue
+                new = row.get(metric)
+                if new is None or not math.isfinite(new):
+                    regressions.append((suite_name, row['name'], metric, old[metric], None))
+                elif new > old[metric] * (1 + threshold):
+                    regressions.append((suite_name, row['name'], metric, old[metric], new))
+    return regressions
+
+
+@suite('render_confirmation')
+def render_confirmation(options):
+    context = {
+        'website_url': settings.WEBSITE['url'],
+        'support_url': settings.WEBSITE['support_url'],
+        'first_name': 'Ann',
+        'token': '1234',
+        'operating_system': 'Linux',
+        'browser_name': 'Firefox',
+    }
+    language = settings.LANGUAGE_CODE
+    renderer = EmailRenderer('emails/confirm_subject.txt', 'emails/confirm.txt', 'emails/confirm.html')
+
+    def render_each():
+        translation.activate(language)
+        render_to_string('emails/confirm_subject.txt', context).replace('\n', '')
+        render_to_string('emails/confirm.txt', context)
+        render_to_string('emails/confirm.html', context)
+
+    def render_cached():
+        renderer.render(context, language)
+
+    number = options['number']
+    return [
+        result('render_to_string x3', measure(render_each, number)),
+        result('EmailRenderer.render', measure(render_cached, number)),
+    ]
+
+
+@suite('render_envelope')
+def render_envelope(options):
+    items = [{'id': i, 'address': 'user{}@example.com'.format(i), 'is_verified': bool(i % 2),
+              'is_primary': i == 0, 'label': None} for i in range(options['items'])]
+
+    def dict_dumps():
+        json.dumps({'status': 'success', 'message': 'Success', 'result': items}, cls=JSONEncoder)
+
+    encoders = [('stdlib', EnvelopeEncoder(StdlibJSONBackend()))]
+    if load_orjson() is not None:
+        encoders.append(('orjson', EnvelopeEncoder(OrjsonBackend())))
+
+    number = options['number']
+    rows = [result('json.dumps(body dict)', measure(dict_dumps, number), items=len(items))]
+    for name, encoder in encoders:
+        rows.append(result('EnvelopeEncoder({})'.format(name),
+                           measure(lambda: encoder.encode('success', 'Success', items), number),
+                           items=len(items)))
+    return rows
+
+
+@suite('request_params')
+def request_params(options):
+    class View(RestView):
+        param_schema = {
+            'id': IntParam(),
+            'email': EmailParam(),
+            'label': StringParam(),
+            'verbose': BoolParam(required=False, default=False),
+            'since': DateParam(required=False),
+        }
+
+    data = {'id': '42', 'email': 'Ann@Example.com', 'label': 'home', 'since': '2018-06-22'}
+    request = Request(APIRequestFactory().post('/?verbose=true', data, format='json'), parsers=[JSONParser()])
+    request.data  # parse once, as DRF does before the handler runs
+    view = View()
+    view._request = request
+
+    def helpers():
+        view.get_int_param('id')
+        view.get_email_param('email')
+        view.get_string_param('label')
+        view.get_bool_param('verbose', default=False, required=False)
+        view.get_date_param('since', required=False)
+
+    def schema():
+        View._extract_params(request)
+
+    number = options['number']
+    return [
+        result('get_*_param helpers', measure(helpers, number)),
+        result('compiled param_schema', measure(schema, number)),
+    ]
+
+
+@suite('request_metrics')
+def request_metrics_overhead(options):
+    class View(RestView):
+        def _get(self):
+            return self.success({})
+
+    view = View.as_view()
+    request = APIRequestFactory().get('/')
+    user = get_user_model().objects.create(username='bench')
+    request.user = request._force_auth_user = user
+
+    number = options['number']
+    rows = []
+    for enabled in (False, True):
+        with override_settings(METRICS=dict(settings.METRICS, enabled=enabled)):
+            rows.append(result('RestView dispatch, metrics {}'.format('on' if enabled else 'off'),
+                               measure(lambda: view(request), number)))
+    return rows
+
+
+@suite('datetime_parse')
+def datetime_parse(options):
+    cases = [
+        ('2018-06-22', '%Y-%m-%d'),
+        ('2018-06-22T04:58:01', None),
+        ('2018-06-22T04:58:01Z', None),
+        ('2018-06-22T04:58:01.123456', None),
+        ('2018-06-22 04:58:01', None),
+        ('2018-06-22 04:58:01.123456', None),
+        ('2018-06-22 04:58:01.123456', '%Y-%m-%d %H:%M:%S.%f'),
+        ('2018-6-2 4:58:01', None),  # not zero padded: strptime with the format memo
+    ]
+    number = options['number']
+    rows = []
+    for var, fmt in cases:
+        fmts = [fmt] if fmt else list(Datetime.formats)
+        label = '{!r}{}'.format(var, ' ' + fmt if fmt else '')
+        rows.append(result('strptime loop ' + label, measure(lambda: Datetime._strptime_formats(var, fmts), number)))
+        rows.append(result('Datetime.strptime ' + label, measure(lambda: Datetime.strptime(var, fmt), number)))
+    values = [var for var, fmt in cases if fmt is None] * 1000
+    rows.append(result('Datetime.parse_many', measure(lambda: Datetime.parse_many(values), 1) / len(values),
+                       values=len(values)))
+    return rows
+
+
+def bulk_insert(model, rows, batch_size=5000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch, batch_size)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch, batch_size)
+
+
+@suite('confirmation_lookup')
+def confirmation_lookup(options):
+    rows = options['rows']
+    users = max(1, rows // 4)
+    emails_per_user = 2
+    expire_secs = settings.WEBSITE['confirmation_timeout']
+    now = timezone.now()
+
+    user_model = get_user_model()
+    bulk_insert(user_model, (user_model(username='bench{}'.format(i)) for i in range(users)))
+    user_ids = list(user_model.objects.filter(username__startswith='bench').values_list('id', flat=True))
+    bulk_insert(Email, (Email(user_id=user_id, address='{}.{}@example.com'.format(user_id, n),
+                              address_normalized='{}.{}@example.com'.format(user_id, n))
+                        for user_id in user_ids for n in range(emails_per_user)))
+    email_users = list(Email.objects.filter(user_id__in=user_ids).values_list('id', 'user_id'))
+    bulk_insert(EmailConfirmation, (
+        EmailConfirmation(email_id=email_id, token_hash=hash_confirmation_token(user_id, '{:04d}'.format(i)),
+                          sent=now - datetime.timedelta(seconds=i % (2 * expire_secs)))
+        for i, (email_id, user_id) in enumerate(email_users * (rows // len(email_users) + 1)) if i < rows))
+
+    user = user_model.objects.get(pk=email_users[0][1])
+    token = '0000'
+
+    def two_queries():
+        token_hash = hash_confirmation_token(user.pk, token)
+        email_ids = Email.objects.filter(user=user).values_list('id', flat=True)
+        try:
+            record = EmailConfirmation.objects.get(token_hash=token_hash, email_id__in=email_ids)
+        except EmailConfirmation.DoesNotExist:
+            return None
+        record.email  # the view goes on to use the email
+        return None if record.token_expired(expire_secs) else record
+
+    def single_query():
+        return EmailConfirmation.get_checked(user, token, expire_secs).email
+
+    number = options['number']
+    return [
+        result('subquery + fetch + python expiry', measure(two_queries, number), rows=rows),
+        result('EmailConfirmation.get_checked', measure(single_query, number), rows=rows),
+    ]
+
+
+@suite('users_for_addresses')
+def users_for_addresses(options):
+    rows = options['rows']
+    addresses = 10000
+    user_model = get_user_model()
+    bulk_insert(user_model, (user_model(username='bench{}'.format(i)) for i in range(max(1, rows // 2))))
+    user_ids = list(user_model.objects.filter(username__startswith='bench').values_list('id', flat=True))
+    bulk_insert(Email, (Email(user_id=user_id, address='{}.{}@example.com'.format(user_id, n),
+                              address_normalized='{}.{}@example.com'.format(user_id, n), is_verified=n == 0)
+                        for user_id in user_ids for n in range(2)))
+
+    # An inbound batch: mostly known senders, some unverified or unknown, a few repeated in other case.
+    known = Email.objects.values_list('address', flat=True)[:addresses * 8 // 10]
+    batch = list(known) + ['nobody{}@example.org'.format(i) for i in range(addresses // 10)]
+    batch += [address.upper() for address in batch[:addresses - len(batch)]]
+
+    def one_by_one():
+        return {address: Email.objects.get_users_for(address) for address in batch}
+
+    def bulk():
+        return Email.objects.get_users_for_many(batch)
+
+    memo = {}
+    Email.objects.get_users_for_many(batch, memo=memo)
+
+    def memoized():
+        return Email.objects.get_users_for_many(batch, memo=memo)
+
+    return [
+        result('get_users_for per address', measure(one_by_one, 1), rows=rows, addresses=len(batch)),
+        result('get_users_for_many', measure(bulk, 1), rows=rows, addresses=len(batch)),
+        result('get_users_for_many, warm memo', measure(memoized, 1), rows=rows, addresses=len(batch)),
+    ]
+
+
+@suite('serialize_emails')
+def serialize_emails(options):
+    rows = 10000
+    user_model = get_user_model()
+    user = user_model.objects.create(username='bench')
+    bulk_insert(Email, (Email(user=user, address='bench{}@example.com'.format(i),
+                              address_normalized='bench{}@example.com'.format(i),
+                              is_verified=bool(i % 2), label='label {}'.format(i) if i % 3 else None)
+                        for i in range(rows)))
+    queryset = Email.objects.filter(user=user).order_by('id')
+    assert EmailSerializer(queryset, many=True).data == EmailReadSerializer(queryset, many=True).data
+
+    results = []
+    for name, serializer_class in (('EmailSerializer', EmailSerializer),
+                                   ('EmailReadSerializer', EmailReadSerializer)):
+        def serialize():
+            return serializer_class(queryset.all(), many=True).data
+
+        tracemalloc.start()
+        serialize()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append(result(name, measure(serialize, max(1, options['number'] // 100)),
+                              rows=rows, peak_kib=peak // 1024))
+    return results
+
+
+class SlowEmailBackend(BaseEmailBackend):
+    """Local mail stub that takes ``delay`` seconds per message, like a slow relay."""
+    delay = 0.05
+
+    def send_messages(self, messages):
+        time.sleep(self.delay * len(messages))
+        return len(messages)
+
+
+def send_confirmation_mail(address, inline):
+    args = ('Confirm your email', 'Your code is 1234', settings.WEBSITE['support_email'], [address])
+    if inline:
+        send_mail(*args, connection=SlowEmailBackend())
+    else:
+        enqueue_mail(*args)
+
+
+class SyncSendView(RestView):
+    """send_confirmation reduced to its I/O: one lookup, then the mail (inline or queued)."""
+    param_schema = {'email': EmailParam()}
+    token_buckets = None
+    inline = False
+
+    def _get(self):
+        address = Email.objects.get(user=self._user,
+                                    address_normalized=Email.objects.normalize_address(self.params['email'])).address
+        send_confirmation_mail(address, self.inline)
+        return self.success({})
+
+
+class AsyncSendView(AsyncRestView):
+    param_schema = {'email': EmailParam()}
+    token_buckets = None
+    inline = False
+
+    async def _get(self):
+        email = await sync_to_async(Email.objects.get)(
+            user=self._user, address_normalized=Email.objects.normalize_address(self.params['email']))
+        # An inline send waits on the relay in the loop's executor, not in the ORM thread.
+        await sync_to_async(send_confirmation_mail, thread_sensitive=not self.inline)(email.address, self.inline)
+        return self.success({})
+
+
+# ROOT_URLCONF for the asgi_concurrency suite.
+urlpatterns = [
+    path('sync/inline/', SyncSendView.as_view(inline=True)),
+    path('sync/outbox/', SyncSendView.as_view()),
+    path('async/inline/', AsyncSendView.as_view(inline=True)),
+    path('async/outbox/', AsyncSendView.as_view()),
+]
+
+
+def _wsgi_clients(url, cookies, concurrency, per_client, workers):
+    """``concurrency`` clients against a threaded WSGI server with ``workers`` threads."""
+    slots = threading.BoundedSemaphore(workers)
+    latencies, errors = [], []
+
+    def client_loop():
+        client = Client()
+        client.cookies.load(cookies)
+        try:
+            for _ in range(per_client):
+                started = time.perf_counter()
+                with slots:
+                    response = client.get(url)
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.content
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=client_loop) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - started, latencies
+
+
+def _asgi_clients(url, cookies, concurrency, per_client):
+    """``concurrency`` clients against the ASGI handler, all on one event loop."""
+    latencies = []
+
+    async def client_loop():
+        client = AsyncClient()
+        client.cookies.load(cookies)
+        for _ in range(per_client):
+            started = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.content
+
+    async def run():
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - started, latencies
+
+
+@suite('asgi_concurrency')
+def asgi_concurrency(options):
+    """WSGI threads vs one ASGI event loop for a confirmation send, with the mail relay
+    stubbed to take ``--mail-delay`` seconds: delivered inline, or queued to the outbox."""
+    user = get_user_model().objects.create(username='bench')
+    Email.objects.create(user=user, address='bench@example.com')
+    login = Client()
+    login.force_login(user)
+    # In the query string itself: Django 3.2's AsyncClient drops GET data.
+    query = '?' + urlencode({'email': 'bench@example.com'})
+    concurrency, workers = options['concurrency'], options['workers']
+    per_client = max(1, options['requests'] // concurrency)
+
+    cases = (
+        ('WSGI x{} threads, inline send'.format(workers), 'sync', '/sync/inline/'),
+        ('ASGI, inline send in executor', 'async', '/async/inline/'),
+        ('WSGI x{} threads, outbox'.format(workers), 'sync', '/sync/outbox/'),
+        ('ASGI, outbox', 'async', '/async/outbox/'),
+    )
+    rows = []
+    SlowEmailBackend.delay = options['mail_delay']
+    with override_settings(ROOT_URLCONF=__name__):
+        for name, server, url in cases:
+            if server == 'sync':
+                wall, latencies = _wsgi_clients(url + query, login.cookies, concurrency, per_client, workers)
+            else:
+                wall, latencies = _asgi_clients(url + query, login.cookies, concurrency, per_client)
+            rows.append(latency_result(name, wall, latencies, concurrency=concurrency))
+    return rows
+
+
+def _account(username, emails):
+    """A logged-in Client for a new user owning ``emails``: [(address, is_verified, is_primary)]."""
+    user = get_user_model().objects.create(username=username, first_name=username.title())
+    Email.objects.bulk_create([Email(user=user, address=address, address_normalized=address,
+                                     is_verified=is_verified, is_primary=is_primary)
+                               for address, is_verified, is_primary in emails])
+    client = Client()
+    client.force_login(user)
+    return client, list(Email.objects.filter(user=user).order_by('id'))
+
+
+def _timed_requests(name, send, number, **extra):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(number):
+        request_started = time.perf_counter()
+        response = send(i)
+        latencies.append(time.perf_counter() - request_started)
+        if not 200 <= response.status_code < 300:
+            raise AssertionError('{} returned {}: {}'.format(name, response.status_code, response.content[:200]))
+    return latency_result(name, time.perf_counter() - started, latencies, **extra)
+
+
+@suite('endpoints')
+def endpoints(options):
+    """Every myapp endpoint through the test client, with session auth and middleware, next to
+    ``--rows`` emails of other accounts; the list is also fetched with a signed bearer token.
+    A list owner has ``--items`` emails; each case makes ``--requests`` requests. Throttling
+    is off and mail goes to the locmem backend."""
+    number, items = options['requests'], options['items']
+    user_model = get_user_model()
+    accounts = max(1, options['rows'] // 4)
+    bulk_insert(user_model, (user_model(username='other{}'.format(i)) for i in range(accounts)))
+    bulk_insert(Email, (Email(user_id=user_id, address='{}.{}@example.com'.format(user_id, n),
+                              address_normalized='{}.{}@example.com'.format(user_id, n),
+                              is_verified=n < 2, is_primary=n == 0)
+                        for user_id in user_model.objects.filter(username__startswith='other').values_list('id', flat=True)
+                        for n in range(4)))
+
+    def bench_address(case, i):
+        return '{}{}@bench.example.com'.format(case, i)
+
+    def list_case():
+        client, _emails = _account('lister', [(bench_address('list', i), True, i == 0) for i in range(items)])
+        bearer = Client(HTTP_AUTHORIZATION='Bearer ' + make_token(user_model.objects.get(username='lister'))['token'])
+        return [
+            _timed_requests('list', lambda i: client.get('/myapp/get/'), number, items=items),
+            _timed_requests('list, bearer token', lambda i: bearer.get('/myapp/get/'), number, items=items),
+            _timed_requests('list, page of 100', lambda i: client.get('/myapp/get/?page_size=100'), number,
+                            items=items),
+        ]
+
+    def add_case():
+        client, _emails = _account('adder', [])
+        return [_timed_requests('add', lambda i: client.post('/myapp/add/', {'email': bench_address('add', i)}),
+                                number)]
+
+    def remove_case():
+        client, emails = _account('remover', [(bench_address('remove', i), False, False) for i in range(number)])
+        return [_timed_requests('remove', lambda i: client.delete('/myapp/remove/?id={}'.format(emails[i].id)),
+                                number)]
+
+    def set_primary_case():
+        client, emails = _account('switcher', [(bench_address('primary', i), True, i == 0) for i in range(2)])
+        return [_timed_requests('set_primary', lambda i: client.post('/myapp/set_primary/',
+                                                                     {'id': emails[(i + 1) % 2].id}), number)]
+
+    def send_confirmation_case():
+        client, emails = _account('sender', [(bench_address('send', 0), False, False)])
+        mail.outbox = []
+        row = _timed_requests('send_confirmation',
+                              lambda i: client.get('/myapp/send_confirmation/?email=' + emails[0].address), number)
+        OutboxWorker(threading.Event()).drain()
+        row['mails'] = len(mail.outbox)
+        return [row]
+
+    def confirm_primary_case():
+        client, emails = _account('confirmer', [(bench_address('confirm', i), False, False) for i in range(number)])
+        tokens = [email.create_confirmation(settings.WEBSITE['confirmation_digits']).token for email in emails]
+        return [_timed_requests('confirm_primary',
+                                lambda i: client.get('/myapp/confirm_primary/?token=' + tokens[i]), number)]
+
+    throttle_off = dict(settings.CACHES, benchmark_throttle={'BACKEND': 'django.core.cache.backends.dummy.DummyCache'})
+    rows = []
+    with override_settings(CACHES=throttle_off, REST_VIEW=dict(settings.REST_VIEW, throttle_cache='benchmark_throttle'),
+                           EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+        for name, case in (('list', list_case), ('add', add_case), ('remove', remove_case),
+                           ('set_primary', set_primary_case), ('send_confirmation', send_confirmation_case),
+                           ('confirm_primary', confirm_primary_case)):
+            try:
+                rows.extend(case())
+            except Exception as e:
+                # Keep going: one broken endpoint should not hide the others' numbers.
+                rows.append({'name': name, 'error': '{}: {}'.format(type(e).__name__, e)})
+    return rows
@@ -0,0 +1,79 @@
+import contextvars
+import functools
+import logging
+
+from django.conf import settings
+
+from .queries import query_observer
+
+logger = logging.getLogger(__name__)
+
+_active = contextvars.ContextVar('myapp_query_budgets', default=())
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryBudget:
+    """Context manager allowing at most ``limit`` database queries inside it.
+
+    Only checked when DEBUG is on, where going over logs a warning with the SQL, or
+    when QUERY_BUDGETS['raise'] is set (as by myapp.testing.TestRunner), where it raises
+    QueryBudgetExceeded. Otherwise entering and leaving it costs a settings lookup.
+    Budgets nest; a query counts against every budget it runs inside.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.queries = []
+        self._token = None
+
+    def __enter__(self):
+        if self.limit is not None and (settings.DEBUG or settings.QUERY_BUDGETS['raise']):
+            self._token = _active.set(_active.get() + (self,))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._token is None:
+            return
+        _active.reset(self._token)
+        self._token = None
+        if exc_type is None and len(self.queries) > self.limit:
+            self.exceeded()
+
+    def exceeded(self):
+        message = '{} made {} queries, over its budget of {}:\n{}'.format(
+            self.name, len(self.queries), self.limit,
+            '\n'.join('  {}. {}{}'.format(i, sql, ' -- {!r}'.format(params) if params else '')
+                      for i, (sql, params) in enumerate(self.queries, 1)))
+        if settings.QUERY_BUDGETS['raise']:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+def query_budget(limit):
+    """Decorator giving a function or method a QueryBudget named after it."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with QueryBudget(func.__qualname__, limit):
+                return func(*args, **kwargs)
+        wrapper.query_budget = limit
+        return wrapper
+    return decorate
+
+
+# Transaction control depends on the backend (SQLite issues BEGIN itself) and on
+# nesting (savepoints inside TestCase); leaving it out keeps a budget's meaning the
+# same in tests and in production.
+_transaction_control = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+@query_observer
+def record_queries(sql, params, seconds):
+    budgets = _active.get()
+    if budgets and not sql.startswith(_transaction_control):
+        for budget in budgets:
+            budget.queries.append((sql, params))
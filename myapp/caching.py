@@ -0,0 +1,179 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.crypto import get_random_string
+
+from .routers import use_replicas
+
+
+class VersionedUserCache:
+    """Per-user cache entries keyed by a per-user version token.
+
+    Invalidating a user just replaces the token, so a fill that raced with a write
+    lands under the old version and is never served. Fills read the primary database:
+    a lagging replica's rows would be stored under the new version and served until
+    they expire. Subclasses name their settings
+    (a dict with 'alias' and 'timeout'); an alias missing from CACHES falls back to a
+    process-local cache.
+    """
+    key_prefix = None
+    setting = None
+
+    def __init__(self, alias=None, timeout=None):
+        self._alias = alias
+        self._timeout = timeout
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            alias = self._alias or getattr(settings, self.setting)['alias']
+            if alias in settings.CACHES:
+                self._cache = caches[alias]
+            else:
+                self._cache = LocMemCache(self.key_prefix, {})
+        return self._cache
+
+    @property
+    def timeout(self):
+        return self._timeout if self._timeout is not None else getattr(settings, self.setting)['timeout']
+
+    def _version_key(self, user_id):
+        return '{}:version:{}'.format(self.key_prefix, user_id)
+
+    def version(self, user_id):
+        key = self._version_key(user_id)
+        version = self.cache.get(key)
+        if version is None:
+            version = get_random_string(12)
+            # add, not set: concurrent first readers must agree on one version.
+            if not self.cache.add(key, version, None):
+                version = self.cache.get(key) or version
+        return version
+
+    def versions(self, user_ids):
+        """``{user_id: version}`` with one cache round trip when every user has a version."""
+        keys = {user_id: self._version_key(user_id) for user_id in user_ids}
+        found = self.cache.get_many(keys.values())
+        return {user_id: found.get(key) or self.version(user_id) for user_id, key in keys.items()}
+
+    def invalidate(self, user_id):
+        """Drop the user's cached entries once the current transaction (if any) commits."""
+        transaction.on_commit(lambda: self._invalidate(user_id))
+
+    def _invalidate(self, user_id):
+        self.cache.set(self._version_key(user_id), get_random_string(12), None)
+
+
+class EmailListCache(VersionedUserCache):
+    """Read-through cache of each user's serialized email list.
+
+    Versioned per user (see VersionedUserCache). Concurrent misses for the same user
+    in this process wait for a single fill instead of each querying the database.
+    """
+    key_prefix = 'myapp:email_list'
+    setting = 'EMAIL_LIST_CACHE'
+
+    def __init__(self, alias=None, timeout=None):
+        super(EmailListCache, self).__init__(alias, timeout)
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, user_id, fill):
+        key = '{}:{}:{}'.format(self.key_prefix, user_id, self.version(user_id))
+        value = self.cache.get(key)
+        if value is not None:
+            self._count(hits=1)
+            return value
+
+        with self._single_flight(key):
+            value = self.cache.get(key)
+            if value is not None:
+                self._count(coalesced=1)
+                return value
+            self._count(misses=1)
+            with use_replicas(False):
+                value = fill()
+            self.cache.set(key, value, self.timeout)
+            return value
+
+    def stats(self):
+        with self._stats_lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+    def _count(self, hits=0, misses=0, coalesced=0):
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += misses
+            self.coalesced += coalesced
+
+    @contextmanager
+    def _single_flight(self, key):
+        with self._flights_lock:
+            lock, waiters = self._flights.get(key, (threading.Lock(), 0))
+            self._flights[key] = (lock, waiters + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._flights_lock:
+                lock, waiters = self._flights[key]
+                if waiters == 1:
+                    del self._flights[key]
+                else:
+                    self._flights[key] = (lock, waiters - 1)
+
+
+email_list_cache = EmailListCache()
+
+
+class PrimaryEmailCache(VersionedUserCache):
+    """Optional cache of each user's primary Email, for EmailManager.get_primary_for_users.
+
+    Off unless PRIMARY_EMAIL_CACHE['alias'] names a cache; versioned per user (see
+    VersionedUserCache). Users without a primary email are cached too, as ``False``.
+    """
+    key_prefix = 'myapp:primary_email'
+    setting = 'PRIMARY_EMAIL_CACHE'
+
+    @property
+    def enabled(self):
+        return (self._alias or settings.PRIMARY_EMAIL_CACHE['alias']) is not None
+
+    def get_many(self, user_ids, verify_check, fill):
+        """``{user_id: Email or None}``; ``fill(missing_ids)`` loads the rest the same way."""
+        keys = {user_id: '{}:{}:{}:{}'.format(self.key_prefix, user_id, int(verify_check), version)
+                for user_id, version in self.versions(user_ids).items()}
+        cached = self.cache.get_many(keys.values())
+        found = {user_id: cached[key] or None for user_id, key in keys.items() if key in cached}
+        missing = [user_id for user_id in user_ids if user_id not in found]
+        if missing:
+            with use_replicas(False):
+                loaded = fill(missing)
+            self.cache.set_many({keys[user_id]: loaded[user_id] or False for user_id in missing}, self.timeout)
+            found.update(loaded)
+        return found
+
+    def invalidate(self, user_id):
+        if self.enabled:
+            super(PrimaryEmailCache, self).invalidate(user_id)
+
+
+primary_email_cache = PrimaryEmailCache()
+
+
+@receiver(setting_changed)
+def reset_user_caches(setting, **kwargs):
+    for cache in (email_list_cache, primary_email_cache):
+        if setting in (cache.setting, 'CACHES'):
+            cache._cache = None
@@ -0,0 +1,18 @@
+from django.core import checks
+from django.core.cache.backends.locmem import LocMemCache
+
+from .caching import email_list_cache
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_email_list_cache(app_configs, **kwargs):
+    """EMAIL_LIST_CACHE must be shared: invalidation only reaches the process that made it."""
+    if isinstance(email_list_cache.cache, LocMemCache):
+        return [checks.Warning(
+            'EMAIL_LIST_CACHE uses a process-local cache.',
+            hint='With several worker processes, the others keep serving a stale list for up to '
+                 "EMAIL_LIST_CACHE['timeout'] seconds after a change. Point its alias at a shared "
+                 'backend such as Redis or Memcached.',
+            id='myapp.W001',
+        )]
+    return []
@@ -6,20 +6,68 @@ class Datetime:
     max = datetime.datetime.max.replace(tzinfo=None)
     min = datetime.datetime.min.replace(tzinfo=None)
 
+    formats = (
+        "%Y-%m-%dT%H:%M:%S",
+        "%Y-%m-%dT%H:%M:%SZ",
+        "%Y-%m-%dT%H:%M:%S.%f",
+        "%Y-%m-%d %H:%M:%S",
+        "%Y-%m-%d %H:%M:%S.%f"
+    )
+
+    # For inputs the fast path does not cover: input shape -> the format that matched it last.
+    _format_memo = {}
+    _format_memo_size = 128
+
     @staticmethod
     def strptime(var, fmt=None):
-        fmts = [fmt] if fmt else [
-            "%Y-%m-%dT%H:%M:%S",
-            "%Y-%m-%dT%H:%M:%SZ",
-            "%Y-%m-%dT%H:%M:%S.%f",
-            "%Y-%m-%d %H:%M:%S",
-            "%Y-%m-%d %H:%M:%S.%f"
-        ]
+        if not var:
+            return None
+        if type(var) is str:
+            value = _parse_canonical(var, fmt)
+            if value is not None:
+                return value
+
+        if fmt:
+            return Datetime._strptime_formats(var, [fmt])
+
+        shape = (len(var), 'T' in var, ' ' in var, 'Z' in var, '.' in var) if type(var) is str else None
+        memo = Datetime._format_memo
+        remembered = memo.get(shape)
+        if remembered is not None:
+            try:
+                return datetime.datetime.strptime(var, remembered).replace(tzinfo=None)
+            except ValueError:
+                pass
+        value, matched = Datetime._strptime_formats(var, list(Datetime.formats), with_format=True)
+        if shape is not None:
+            if len(memo) >= Datetime._format_memo_size:
+                memo.clear()
+            memo[shape] = matched
+        return value
+
+    @staticmethod
+    def parse_many(values, fmt=None, errors='raise'):
+        """``strptime`` over many values; with ``errors='ignore'`` unparsable values become None."""
+        strptime = Datetime.strptime
+        if errors == 'raise':
+            return [strptime(var, fmt) for var in values]
+        parsed = []
+        for var in values:
+            try:
+                parsed.append(strptime(var, fmt))
+            except (ValueError, TypeError):
+                parsed.append(None)
+        return parsed
+
+    @staticmethod
+    def _strptime_formats(var, fmts, with_format=False):
         for fmt in fmts:
             try:
-                return datetime.datetime.strptime(var, fmt).replace(tzinfo=None) if var else None
+                value = datetime.datetime.strptime(var, fmt).replace(tzinfo=None) if var else None
             except ValueError:
                 pass
+            else:
+                return (value, fmt) if with_format else value
         raise ValueError("time data '{}' does not match formats {}".format(var, fmts))
 
     @staticmethod
@@ -42,3 +90,49 @@ class Datetime:
     @staticmethod
     def to_datetime(date):
         return datetime.datetime.combine(date, datetime.time.min).replace(tzinfo=None)
+
+
+_DATE_ONLY = "%Y-%m-%d"
+
+
+def _parse_canonical(var, fmt):
+    """Parse zero-padded ISO shapes directly, or return None to fall back to strptime.
+
+    Only inputs that ``strptime(var, fmt)`` would parse to the same value are handled:
+    ``YYYY-MM-DD``, and ``YYYY-MM-DD[T ]HH:MM:SS`` optionally followed by ``Z`` (with T)
+    or by ``.`` and 1-6 fraction digits.
+    """
+    n = len(var)
+    if n < 10 or var[4] != '-' or var[7] != '-':
+        return None
+    if n == 10:
+        matched = _DATE_ONLY
+        digits = var[0:4] + var[5:7] + var[8:10]
+    else:
+        if n < 19 or var[13] != ':' or var[16] != ':':
+            return None
+        sep = var[10]
+        digits = var[0:4] + var[5:7] + var[8:10] + var[11:13] + var[14:16] + var[17:19]
+        if n == 19:
+            matched = "%Y-%m-%dT%H:%M:%S" if sep == 'T' else "%Y-%m-%d %H:%M:%S" if sep == ' ' else None
+        elif n == 20 and var[19] == 'Z':
+            matched = "%Y-%m-%dT%H:%M:%SZ" if sep == 'T' else None
+        elif 21 <= n <= 26 and var[19] == '.':
+            matched = "%Y-%m-%dT%H:%M:%S.%f" if sep == 'T' else "%Y-%m-%d %H:%M:%S.%f" if sep == ' ' else None
+            digits += var[20:]
+        else:
+            return None
+        if matched is None:
+            return None
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    if fmt != matched and (fmt or matched not in Datetime.formats):
+        return None
+    try:
+        if n == 10:
+            return datetime.datetime(int(var[0:4]), int(var[5:7]), int(var[8:10]))
+        microsecond = int(var[20:].ljust(6, '0')) if n > 20 else 0
+        return datetime.datetime(int(var[0:4]), int(var[5:7]), int(var[8:10]),
+                                 int(var[11:13]), int(var[14:16]), int(var[17:19]), microsecond)
+    except ValueError:
+        return None
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+from django.template import Context
+from django.template.loader import select_template
+from django.utils import translation
+
+
+class EmailRenderer:
+    """Renders the subject, text and html parts of one kind of email.
+
+    The three templates are resolved and compiled once per language and kept in a
+    small LRU cache; a language specific ``emails/<language>/<name>`` template wins
+    over the shared ``emails/<name>`` one. All parts are rendered from one Context.
+    """
+
+    def __init__(self, subject_template, text_template, html_template, maxsize=16):
+        self._template_names = (subject_template, text_template, html_template)
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def templates(self, language):
+        with self._lock:
+            templates = self._cache.get(language)
+            if templates is not None:
+                self._cache.move_to_end(language)
+                return templates
+
+        templates = tuple(self._compile(name, language) for name in self._template_names)
+
+        with self._lock:
+            self._cache[language] = templates
+            self._cache.move_to_end(language)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+        return templates
+
+    def render(self, context, language):
+        subject_template, text_template, html_template = self.templates(language)
+        context = Context(context)
+        with translation.override(language):
+            subject = subject_template.render(context)
+            text = text_template.render(context)
+            html = html_template.render(context)
+        return subject.replace('\n', ''), text, html
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    @staticmethod
+    def _compile(name, language):
+        directory, _, filename = name.rpartition('/')
+        localized = '/'.join(part for part in (directory, language, filename) if part)
+        # select_template returns the backend wrapper; keep the engine-level Template so
+        # a single Context can be shared by all parts.
+        return select_template([localized, name]).template
+
+
+confirmation_renderer = EmailRenderer('emails/confirm_subject.txt', 'emails/confirm.txt', 'emails/confirm.html')
@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def load_orjson():
+    """The orjson module, or None when it is not installed.
+
+    Imported on first use rather than with this module, so workers on the stdlib
+    backend do not pay for it at start-up.
+    """
+    try:
+        import orjson
+    except ImportError:  # optional dependency
+        return None
+    return orjson
+
+
+class StdlibJSONBackend:
+    """``json.dumps(obj, cls=JSONEncoder)`` with the encoder built once."""
+    name = 'stdlib'
+
+    def __init__(self):
+        self._encode = JSONEncoder().encode
+
+    def dumps(self, obj):
+        return self._encode(obj)
+
+
+class OrjsonBackend:
+    """orjson with DRF's encoder for everything orjson does not handle itself.
+
+    Datetimes are passed through to DRF so values are formatted the same way,
+    but the output is compact and non-ASCII is not escaped: equivalent JSON,
+    not byte-identical to the stdlib backend.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        orjson = load_orjson()
+        self._dumps = orjson.dumps
+        self._default = JSONEncoder().default
+        self._option = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self, obj):
+        return self._dumps(obj, default=self._default, option=self._option)
+
+
+backends = {
+    StdlibJSONBackend.name: StdlibJSONBackend,
+    OrjsonBackend.name: OrjsonBackend,
+}
+
+
+class EnvelopeEncoder:
+    """Encodes the ``{"status", "message", "result"}`` response envelope.
+
+    The envelope is assembled from pre-encoded pieces instead of a dict, and large
+    ``result`` lists can be produced incrementally. With the stdlib backend the
+    output is byte-for-byte what ``json.dumps(body, cls=JSONEncoder)`` produced.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        if isinstance(backend, StdlibJSONBackend):
+            self._separator, self._colon = ', ', ': '
+        else:
+            self._separator, self._colon = ',', ':'
+        self._prefixes = {}
+
+    def _prefix(self, status_name):
+        prefix = self._prefixes.get(status_name)
+        if prefix is None:
+            prefix = '{{"status"{1}{0}{2}"message"{1}'.format(self._text(self.backend.dumps(status_name)),
+                                                              self._colon, self._separator)
+            self._prefixes[status_name] = prefix
+        return prefix
+
+    def encode(self, status_name, msg, result):
+        return ''.join((
+            self._prefix(status_name), self._text(self.backend.dumps(msg)),
+            self._separator, '"result"', self._colon, self._text(self.backend.dumps(result)), '}',
+        ))
+
+    def iter_encode(self, status_name, msg, result, chunk_size=256):
+        dumps, text = self.backend.dumps, self._text
+        yield ''.join((self._prefix(status_name), text(dumps(msg)), self._separator, '"result"', self._colon, '['))
+        for start in range(0, len(result), chunk_size):
+            chunk = self._separator.join(text(dumps(item)) for item in result[start:start + chunk_size])
+            yield self._separator + chunk if start else chunk
+        yield ']}'
+
+    @staticmethod
+    def _text(encoded):
+        return encoded.decode('utf-8') if isinstance(encoded, bytes) else encoded
+
+
+_envelope_encoder = None
+
+
+def get_envelope_encoder():
+    """The encoder for REST_VIEW['json_backend']; falls back to the stdlib if orjson is missing."""
+    global _envelope_encoder
+    if _envelope_encoder is None:
+        name = settings.REST_VIEW['json_backend']
+        if name == OrjsonBackend.name and load_orjson() is None:
+            name = StdlibJSONBackend.name
+        _envelope_encoder = EnvelopeEncoder(backends[name]())
+    return _envelope_encoder
+
+
+@receiver(setting_changed)
+def reset_envelope_encoder(setting, **kwargs):
+    global _envelope_encoder
+    if setting == 'REST_VIEW':
+        _envelope_encoder = None
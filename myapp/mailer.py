@@ -0,0 +1,140 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_mail(subject, message, from_email, recipient_list, html_message=None):
+    """Drop-in replacement for ``send_mail`` that writes to the outbox instead of talking SMTP."""
+    return OutboundEmail.objects.enqueue(subject, message, from_email, recipient_list,
+                                         html_message=html_message)
+
+
+class OutboxWorker(threading.Thread):
+    """Drains the outbox in batches, keeping one mail connection open across a busy period."""
+
+    def __init__(self, stop_event, batch_size=None, poll_interval=None, stats=None, name=None):
+        super(OutboxWorker, self).__init__(name=name, daemon=True)
+        conf = settings.EMAIL_OUTBOX
+        self._stop_event = stop_event
+        self._batch_size = batch_size or conf['batch_size']
+        self._poll_interval = poll_interval if poll_interval is not None else conf['poll_interval']
+        self._lease_secs = conf['lease_secs']
+        self._max_attempts = conf['max_attempts']
+        self._backoff_secs = conf['backoff_secs']
+        self._stats = stats if stats is not None else OutboxStats()
+        self._connection = None
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                if not self.drain_once():
+                    self._close_connection()
+                    self._stop_event.wait(self._poll_interval)
+        finally:
+            self._close_connection()
+            connection.close()
+
+    def drain(self):
+        """Deliver everything that is currently due, then release the connection."""
+        try:
+            while self.drain_once():
+                pass
+        finally:
+            self._close_connection()
+
+    def drain_once(self):
+        batch = OutboundEmail.objects.claim_batch(self._batch_size, self._lease_secs)
+        if batch:
+            self.deliver(batch)
+        return len(batch)
+
+    def deliver(self, batch):
+        sent_ids = []
+        for outbound in batch:
+            try:
+                self._send(outbound)
+            except Exception as e:
+                logger.warning('Failed to send outbound email %d (attempt %d): %s',
+                               outbound.id, outbound.attempts + 1, e)
+                # The connection may be the thing that broke; start the next message on a fresh one.
+                self._close_connection()
+                if not OutboundEmail.objects.mark_failed(outbound, e, self._max_attempts, self._backoff_secs):
+                    logger.warning('Lost the lease on outbound email %d; leaving it to its new claim', outbound.id)
+                self._stats.add(failed=1)
+            else:
+                sent_ids.append(outbound.id)
+        if sent_ids:
+            marked = OutboundEmail.objects.mark_sent(sent_ids, batch[0].claim)
+            if marked < len(sent_ids):
+                logger.warning('Lost the lease on %d of %d sent outbound emails; they may be sent again',
+                               len(sent_ids) - marked, len(sent_ids))
+            self._stats.add(sent=len(sent_ids))
+
+    def _send(self, outbound):
+        if self._connection is None:
+            self._connection = get_connection(fail_silently=False)
+            self._connection.open()
+        message = EmailMultiAlternatives(
+            subject=outbound.subject,
+            body=outbound.body,
+            from_email=outbound.from_email,
+            to=outbound.recipient_list,
+            connection=self._connection,
+        )
+        if outbound.html_body:
+            message.attach_alternative(outbound.html_body, 'text/html')
+        message.send()
+
+    def _close_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+
+class OutboxStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def add(self, sent=0, failed=0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+
+
+class OutboxWorkerPool:
+    def __init__(self, workers=None, batch_size=None, poll_interval=None):
+        self._workers = workers or settings.EMAIL_OUTBOX['workers']
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._threads = []
+        self.stats = OutboxStats()
+
+    def start(self):
+        for i in range(self._workers):
+            worker = OutboxWorker(self._stop_event, batch_size=self._batch_size,
+                                  poll_interval=self._poll_interval, stats=self.stats,
+                                  name='outbox-worker-{}'.format(i))
+            worker.start()
+            self._threads.append(worker)
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        for worker in self._threads:
+            worker.join(timeout)
+        self._threads = []
+
+    def is_alive(self):
+        return any(worker.is_alive() for worker in self._threads)
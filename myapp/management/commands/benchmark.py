@@ -0,0 +1,93 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from myapp.benchmarks import compare, suites
+
+# Options saved with a baseline; --compare refuses a baseline recorded with different ones.
+BASELINE_OPTIONS = ('number', 'rows', 'items', 'requests', 'concurrency', 'workers', 'mail_delay')
+
+
+class Command(BaseCommand):
+    help = "Run micro-benchmarks. Available suites: see --list."
+
+    def add_arguments(self, parser):
+        parser.add_argument('suites', nargs='*', help="Suites to run (default: all).")
+        parser.add_argument('--list', action='store_true', help="List available suites.")
+        parser.add_argument('--number', type=int, default=1000, help="Calls per timing run.")
+        parser.add_argument('--rows', type=int, default=100000, help="Table size for database suites.")
+        parser.add_argument('--items', type=int, default=100, help="Result list length for encoding suites.")
+        parser.add_argument('--requests', type=int, default=256, help="Requests per case for server suites.")
+        parser.add_argument('--concurrency', type=int, default=32, help="Concurrent clients for server suites.")
+        parser.add_argument('--workers', type=int, default=4, help="WSGI server threads for server suites.")
+        parser.add_argument('--mail-delay', type=float, default=0.05, help="Seconds the mail stub takes per message.")
+        parser.add_argument('--save', metavar='FILE', help="Write the results to FILE as a JSON baseline.")
+        parser.add_argument('--compare', metavar='FILE', help="Compare the results with a JSON baseline.")
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help="Slowdown that counts as a regression with --compare (default 0.1 = 10%%).")
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for name in suites:
+                self.stdout.write(name)
+            return
+
+        names = options['suites'] or list(suites)
+        unknown = [name for name in names if name not in suites]
+        if unknown:
+            raise CommandError("Unknown suite(s): {}".format(', '.join(unknown)))
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                saved = json.load(f)
+            # Timings only compare between runs of the same size.
+            differences = ['--{} {} (baseline: {})'.format(key.replace('_', '-'), options[key], value)
+                           for key, value in sorted(saved.get('options', {}).items())
+                           if key in BASELINE_OPTIONS and options[key] != value]
+            if differences:
+                raise CommandError("{} was recorded with other options: {}".format(
+                    options['compare'], ', '.join(differences)))
+            baseline = saved['results']
+
+        all_results = {}
+        for name in names:
+            self.stdout.write("== {}".format(name))
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                # As in production (no query log, no debug-only checks), but reachable by the test client.
+                with override_settings(DEBUG=False, ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+                    results = suites[name](options)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+            all_results[name] = results
+            for row in results:
+                extra = ''.join(', {}: {}'.format(k, v) for k, v in row.items() if k not in ('name', 'per_op_us'))
+                if 'per_op_us' in row:
+                    self.stdout.write("  {:<60} {:>12.2f} us/op{}".format(row['name'], row['per_op_us'], extra))
+                else:
+                    self.stdout.write("  {:<60} {:>18}{}".format(row['name'], 'failed', extra))
+
+        if options['save']:
+            settings_used = {key: options[key] for key in BASELINE_OPTIONS}
+            with open(options['save'], 'w') as f:
+                json.dump({'options': settings_used, 'results': all_results}, f, indent=2, sort_keys=True)
+            self.stdout.write("Saved baseline to {}".format(options['save']))
+
+        if baseline is not None:
+            regressions = compare(baseline, all_results, options['threshold'])
+            for suite_name, row_name, metric, old, new in regressions:
+                if metric == 'error':
+                    change = new
+                elif metric == 'missing':
+                    change = "row not produced"
+                elif new is None:
+                    change = "{:.2f} -> no result".format(old)
+                else:
+                    change = "{:.2f} -> {:.2f} ({:+.0%})".format(old, new, new / old - 1)
+                self.stdout.write("REGRESSION {} / {}: {} {}".format(suite_name, row_name, metric, change))
+            if regressions:
+                raise CommandError("{} regression(s) beyond {:.0%}".format(len(regressions), options['threshold']))
+            self.stdout.write("No regressions beyond {:.0%}".format(options['threshold']))
@@ -0,0 +1,124 @@
+import datetime
+import math
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from myapp.models import Email, EmailConfirmation, hash_confirmation_token
+
+# Rough share of addresses per provider.
+DOMAINS = ('gmail.com', 'yahoo.com', 'outlook.com', 'hotmail.com', 'icloud.com', 'example.com')
+DOMAIN_WEIGHTS = (40, 15, 15, 10, 8, 12)
+
+
+class Command(BaseCommand):
+    help = ("Generate synthetic users with emails and pending confirmations. The data depends only "
+            "on the options and --seed, not on the chunk size or the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000, help="Users to create.")
+        parser.add_argument('--mean-emails', type=float, default=1.6,
+                            help="Mean emails per user; geometric, at least one (default 1.6).")
+        parser.add_argument('--max-emails', type=int, default=10, help="Most emails one user gets.")
+        parser.add_argument('--verified-ratio', type=float, default=0.7, help="Share of verified emails.")
+        parser.add_argument('--primary-ratio', type=float, default=0.95,
+                            help="Share of users with a verified email that have a primary one.")
+        parser.add_argument('--pending-ratio', type=float, default=0.3,
+                            help="Share of unverified emails with a pending confirmation.")
+        parser.add_argument('--mean-confirmation-age', type=float, default=3 * 86400,
+                            help="Mean age in seconds of pending confirmations; exponential, so most "
+                                 "are past WEBSITE['confirmation_timeout'] (default 3 days).")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help="Users written per transaction; bounds memory use.")
+        parser.add_argument('--prefix', default='gen', help="Username and address prefix.")
+
+    def handle(self, *args, **options):
+        for name in ('verified_ratio', 'primary_ratio', 'pending_ratio'):
+            if not 0 <= options[name] <= 1:
+                raise CommandError("--{} must be between 0 and 1.".format(name.replace('_', '-')))
+        if options['mean_emails'] < 1 or options['max_emails'] < 1:
+            raise CommandError("Every user has at least one email.")
+        if 10 ** settings.WEBSITE['confirmation_digits'] < options['max_emails']:
+            raise CommandError("--max-emails exceeds the number of distinct confirmation codes.")
+        if get_user_model().objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError("Users with prefix '{}' already exist; pick another --prefix.".format(options['prefix']))
+
+        now = timezone.now()
+        totals = [0, 0, 0]
+        started = time.time()
+        users, chunk_size = options['users'], options['chunk_size']
+        for start in range(0, users, chunk_size):
+            with transaction.atomic():
+                counts = self._write_chunk(start, min(users, start + chunk_size), options, now)
+            totals = [total + count for total, count in zip(totals, counts)]
+            self.stdout.write("{} users, {} emails, {} confirmations ({:.0f}s)".format(
+                totals[0], totals[1], totals[2], time.time() - started))
+
+    def _plan(self, index, options):
+        """Emails ``[address, is_verified, is_primary, confirmation_age, code]`` of user ``index``."""
+        # One generator per user keeps the data independent of the chunk size.
+        rng = random.Random(options['seed'] * 2 ** 40 + index)
+        p = 1.0 / options['mean_emails']
+        extra = 0 if p >= 1 else int(math.log(1.0 - rng.random()) / math.log(1.0 - p))
+        emails = []
+        for n in range(min(options['max_emails'], 1 + extra)):
+            address = '{}{}.{}@{}'.format(options['prefix'], index, n, rng.choices(DOMAINS, DOMAIN_WEIGHTS)[0])
+            if rng.random() < 0.1:
+                address = address.capitalize()
+            emails.append([address, rng.random() < options['verified_ratio'], False, None, None])
+
+        verified = [email for email in emails if email[1]]
+        if verified and rng.random() < options['primary_ratio']:
+            rng.choice(verified)[2] = True
+        pending = [email for email in emails if not email[1] and rng.random() < options['pending_ratio']]
+        codes = rng.sample(range(10 ** settings.WEBSITE['confirmation_digits']), len(pending))
+        for email, code in zip(pending, codes):
+            email[3] = rng.expovariate(1.0 / options['mean_confirmation_age'])
+            email[4] = '{:0{}d}'.format(code, settings.WEBSITE['confirmation_digits'])
+        return emails
+
+    def _write_chunk(self, start, stop, options, now):
+        user_model = get_user_model()
+        first, last = self._username(options, start), self._username(options, stop - 1)
+        plans = [self._plan(index, options) for index in range(start, stop)]
+
+        primary = [next((email[0] for email in plan if email[2]), '') for plan in plans]
+        user_model.objects.bulk_create([
+            user_model(username=self._username(options, index), email=primary[index - start], password='!')
+            for index in range(start, stop)
+        ])
+        # Usernames are zero padded, so the chunk is one range (bulk_create does not return ids on MySQL).
+        chunk_users = user_model.objects.filter(username__gte=first, username__lte=last)
+        user_ids = dict(chunk_users.values_list('username', 'id'))
+        user_ids = [user_ids[self._username(options, index)] for index in range(start, stop)]
+
+        Email.objects.bulk_create([
+            Email(user_id=user_id, address=address, address_normalized=Email.objects.normalize_address(address),
+                  is_verified=is_verified, is_primary=is_primary)
+            for user_id, plan in zip(user_ids, plans)
+            for address, is_verified, is_primary, _age, _code in plan
+        ])
+
+        pending = {Email.objects.normalize_address(email[0]): (user_id, email[3], email[4])
+                   for user_id, plan in zip(user_ids, plans) for email in plan if email[4] is not None}
+        confirmations = []
+        if pending:
+            for email_id, address in Email.objects.filter(user__in=chunk_users, is_verified=False).values_list(
+                    'id', 'address_normalized'):
+                if address in pending:
+                    user_id, age, code = pending[address]
+                    sent = now - datetime.timedelta(seconds=age)
+                    confirmations.append(EmailConfirmation(email_id=email_id, token_hash=hash_confirmation_token(
+                        user_id, code), created=sent, sent=sent))
+            EmailConfirmation.objects.bulk_create(confirmations)
+        return stop - start, sum(len(plan) for plan in plans), len(confirmations)
+
+    @staticmethod
+    def _username(options, index):
+        return '{}{:010d}'.format(options['prefix'], index)
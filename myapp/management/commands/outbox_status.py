@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from myapp.models import OutboundEmail
+
+
+class Command(BaseCommand):
+    help = "Show outbox queue depth and recent send throughput."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=300, help="Throughput window in seconds.")
+
+    def handle(self, *args, **options):
+        counts = dict(OutboundEmail.objects.values_list('status').annotate(n=Count('id')).order_by())
+        for status, _ in OutboundEmail.STATUS_CHOICES:
+            self.stdout.write("{}: {}".format(status, counts.get(status, 0)))
+        self.stdout.write("queue depth: {}".format(OutboundEmail.objects.queue_depth()))
+        self.stdout.write("throughput: {:.2f}/s over the last {}s".format(
+            OutboundEmail.objects.throughput(options['window']), options['window']))
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myapp.models import EmailConfirmation
+
+
+class Command(BaseCommand):
+    help = "Delete expired email confirmations in bounded chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expire-secs', type=int, default=None,
+                            help="Age after which a sent confirmation is expired "
+                                 "(default: WEBSITE['confirmation_timeout']).")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Rows deleted per statement.")
+        parser.add_argument('--pause', type=float, default=0,
+                            help="Seconds to sleep between chunks to leave room for other writers.")
+
+    def handle(self, *args, **options):
+        expire_secs = options['expire_secs']
+        if expire_secs is None:
+            expire_secs = settings.WEBSITE['confirmation_timeout']
+        deleted = EmailConfirmation.objects.delete_expired_confirmations(
+            expire_secs, chunk_size=options['chunk_size'], pause=options['pause'])
+        self.stdout.write("Deleted {} expired email confirmations.".format(deleted))
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp.mailer import OutboxWorker, OutboxWorkerPool, OutboxStats
+from myapp.models import OutboundEmail
+
+
+class Command(BaseCommand):
+    help = "Run a pool of workers that deliver queued outbound emails."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Number of worker threads.")
+        parser.add_argument('--batch-size', type=int, default=None, help="Messages claimed per batch.")
+        parser.add_argument('--poll-interval', type=float, default=None,
+                            help="Seconds an idle worker sleeps before polling again.")
+        parser.add_argument('--report-interval', type=float, default=60,
+                            help="Seconds between queue depth / throughput reports.")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain everything that is currently due in this process and exit.")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            return self._drain(options)
+
+        pool = OutboxWorkerPool(workers=options['workers'], batch_size=options['batch_size'],
+                                poll_interval=options['poll_interval'])
+        pool.start()
+        self.stdout.write("Started outbox workers.")
+        last_sent, last_time = 0, time.time()
+        try:
+            while pool.is_alive():
+                time.sleep(options['report_interval'])
+                now = time.time()
+                sent = pool.stats.sent
+                self.stdout.write("queue depth: {}, sent: {:.2f}/s, failed: {}".format(
+                    OutboundEmail.objects.queue_depth(), (sent - last_sent) / (now - last_time),
+                    pool.stats.failed))
+                last_sent, last_time = sent, now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.stop()
+            self.stdout.write("Stopped outbox workers (sent: {}, failed: {}).".format(
+                pool.stats.sent, pool.stats.failed))
+
+    def _drain(self, options):
+        stats = OutboxStats()
+        worker = OutboxWorker(None, batch_size=options['batch_size'], stats=stats)
+        started = time.time()
+        worker.drain()
+        self.stdout.write("sent: {}, failed: {}, {:.2f}s".format(stats.sent, stats.failed, time.time() - started))
@@ -0,0 +1,80 @@
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter, since this one has imported everything already.
+SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+__import__(sys.argv[1])  # unlike importlib.import_module, reported by -X importtime
+total = time.perf_counter() - started
+from myapp import startup
+print(json.dumps({'total': total, 'warmup': list(startup.last_warmup.items())}))
+"""
+
+
+class Command(BaseCommand):
+    help = ("Import the WSGI module in a fresh interpreter and rank where its start-up time goes: "
+            "imports (python -X importtime) and STARTUP warmup steps.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help="Modules and packages to list.")
+        parser.add_argument('--json', action='store_true', help="Print the full report as JSON.")
+
+    def handle(self, *args, **options):
+        module = settings.WSGI_APPLICATION.rpartition('.')[0]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT, module], env=env,
+                                 cwd=settings.BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        imports, errors = self._parse_importtime(process.stderr)
+        if process.returncode:
+            raise CommandError("Importing {} failed:\n{}".format(module, '\n'.join(errors)))
+        report = json.loads(process.stdout.splitlines()[-1])
+
+        packages = defaultdict(float)
+        for name, self_ms, _cumulative_ms in imports:
+            packages[name.partition('.')[0]] += self_ms
+        report.update(
+            module=module,
+            modules=sorted(imports, key=lambda row: -row[2]),
+            packages=sorted(packages.items(), key=lambda row: -row[1]),
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        limit = options['limit']
+        self.stdout.write("Start-up of {}: {:.1f} ms, of which warmup {:.1f} ms".format(
+            module, report['total'] * 1000, sum(seconds for _name, seconds in report['warmup']) * 1000))
+        self.stdout.write("Import times include -X importtime's own overhead; warmup steps include "
+                          "the imports they trigger.")
+        self.stdout.write("\nSlowest imports (cumulative / self ms):")
+        for name, self_ms, cumulative_ms in report['modules'][:limit]:
+            self.stdout.write("  {:9.1f} {:9.1f}  {}".format(cumulative_ms, self_ms, name))
+        self.stdout.write("\nPackages (self ms):")
+        for name, self_ms in report['packages'][:limit]:
+            self.stdout.write("  {:9.1f}  {}".format(self_ms, name))
+        self.stdout.write("\nWarmup steps (ms):")
+        if not report['warmup']:
+            self.stdout.write("  off (STARTUP['warmup'])")
+        for name, seconds in report['warmup']:
+            self.stdout.write("  {:9.1f}  {}".format(seconds * 1000, name))
+
+    @staticmethod
+    def _parse_importtime(stderr):
+        """``[(module, self ms, cumulative ms)]`` and the other lines of ``-X importtime`` output."""
+        imports, other = [], []
+        for line in stderr.splitlines():
+            if not line.startswith('import time:'):
+                other.append(line)
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            if self_us.strip().isdigit():
+                imports.append((name.strip(), int(self_us) / 1000, int(cumulative_us) / 1000))
+        return imports, other
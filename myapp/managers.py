@@ -1,32 +1,173 @@
-from django.db import models
+import datetime
+import time
+
+from django.db import connections, models, transaction
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .budgets import QueryBudget, query_budget
+from .caching import primary_email_cache
 
 
 class EmailManager(models.Manager):
+    @classmethod
+    def normalize_address(cls, address):
+        """Canonical form used for uniqueness and lookups: surrounding whitespace dropped, lowercased."""
+        return (address or '').strip().lower()
+
+    @query_budget(6)  # the insert, plus Email.send_confirmation
     def add_email(self, user, address, **kwargs):
         confirm = kwargs.pop("confirm", False)
-        email_address = self.create(user=user, address=address, **kwargs)
-        if confirm and not email_address.verified:
-            email_address.send_confirmation()
+        with transaction.atomic(using=self.db):
+            email_address = self.create(user=user, address=address, **kwargs)
+            if confirm and not email_address.is_verified:
+                email_address.send_confirmation(user)
         return email_address
 
+    @query_budget(1)
     def get_primary(self, user, verify_check=True):
-        obj = self.filter(user=user, primary=True)
-        if verify_check:
-            obj = obj.filter(verified=True)
+        user_id = getattr(user, 'pk', user)
+        return self.get_primary_for_users([user_id], verify_check)[user_id]
 
-        obj = obj.first()
-        if obj:
-            return obj
-        else:
-            return None
+    def get_primary_for_users(self, user_ids, verify_check=True, chunk_size=500):
+        """Primary email of each user, as ``{user_id: Email or None}``.
+
+        One query per ``chunk_size`` users, served by the (user, is_primary, is_verified)
+        index; goes through the primary email cache when PRIMARY_EMAIL_CACHE enables it.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if primary_email_cache.enabled:
+            return primary_email_cache.get_many(user_ids, verify_check,
+                                                lambda missing: self._load_primary(missing, verify_check, chunk_size))
+        return self._load_primary(user_ids, verify_check, chunk_size)
 
+    def _load_primary(self, user_ids, verify_check, chunk_size):
+        primary = dict.fromkeys(user_ids)
+        for start in range(0, len(user_ids), chunk_size):
+            emails = self.filter(user_id__in=user_ids[start:start + chunk_size], is_primary=True)
+            if verify_check:
+                emails = emails.filter(is_verified=True)
+            # The number of chunks depends on the input, so the budget is per chunk.
+            with QueryBudget('EmailManager.get_primary_for_users chunk', 1):
+                for email in emails:
+                    primary[email.user_id] = email
+        return primary
+
+    @query_budget(1)
     def get_users_for(self, address):
         # this is a list rather than a generator because we probably want to do a len() on it right away
-        return [address.user for address in self.filter(verified=True, address=address)]
+        return self.get_users_for_many([address])[address]
+
+    def get_users_for_many(self, addresses, chunk_size=500, memo=None):
+        """Owners of the verified emails among ``addresses``, as ``{address: [user, ...]}``.
+
+        Every given address is a key, with an empty list when nobody verified it. Lookups go
+        by normalized address, one joined query per ``chunk_size`` addresses not yet in
+        ``memo``; pass the same dict to every call of a batch to resolve each address once.
+        """
+        memo = {} if memo is None else memo
+        normalized = {address: self.normalize_address(address) for address in addresses}
+        missing = [address for address in set(normalized.values()) if address not in memo]
+        if missing:
+            user_model = self.model._meta.get_field('user').remote_field.model
+            related = self.model._meta.get_field('user').related_query_name()
+            users_by_id = {}
+            for start in range(0, len(missing), chunk_size):
+                chunk = missing[start:start + chunk_size]
+                users = user_model.objects.filter(**{
+                    related + '__address_normalized__in': chunk,
+                    related + '__is_verified': True,
+                }).annotate(matched_address=models.F(related + '__address_normalized'))
+                # Memoized only once the chunk's query is through: a chunk that fails must
+                # not leave its addresses resolved to nobody.
+                found = {address: [] for address in chunk}
+                # The number of chunks depends on the input, so the budget is per chunk.
+                with QueryBudget('EmailManager.get_users_for_many chunk', 1):
+                    for user in users:
+                        found[user.matched_address].append(users_by_id.setdefault(user.pk, user))
+                memo.update(found)
+        # Copies, so callers can change their lists without corrupting the memo.
+        return {address: list(memo[normalized_address]) for address, normalized_address in normalized.items()}
 
 
 class EmailConfirmationManager(models.Manager):
-    def delete_expired_confirmations(self):
-        for confirmation in self.all():
-            if confirmation.key_expired():
-                confirmation.delete()
+    def delete_expired_confirmations(self, confirm_expire_secs, chunk_size=1000, pause=0):
+        """Delete confirmations sent more than ``confirm_expire_secs`` ago, oldest first.
+
+        Rows are removed ``chunk_size`` at a time by primary key, each chunk in its own
+        short statement, so the table is never scanned into Python or locked for long.
+        Returns the number of deleted rows.
+        """
+        cutoff = timezone.now() - datetime.timedelta(seconds=confirm_expire_secs)
+        expired = self.filter(sent__lte=cutoff).order_by('sent')
+        deleted = 0
+        while True:
+            ids = list(expired.values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                return deleted
+            deleted += self.filter(id__in=ids).delete()[0]
+            if len(ids) < chunk_size:
+                return deleted
+            if pause:
+                time.sleep(pause)
+
+
+class OutboundEmailManager(models.Manager):
+    @query_budget(1)
+    def enqueue(self, subject, message, from_email, recipient_list, html_message=None):
+        return self.create(subject=subject, body=message, html_body=html_message,
+                           from_email=from_email, recipients=','.join(recipient_list))
+
+    @query_budget(3)
+    def claim_batch(self, batch_size, lease_secs):
+        # Rows are claimed with a conditional UPDATE, so two workers that read the
+        # same candidates never both win them; a crashed worker's claim lapses
+        # once ``next_attempt`` (the lease) passes and the rows become due again.
+        now = timezone.now()
+        due = self.filter(status__in=(self.model.STATUS_PENDING, self.model.STATUS_SENDING),
+                          next_attempt__lte=now)
+        with transaction.atomic(using=self.db):
+            candidates = due.order_by('next_attempt')
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                candidates = candidates.select_for_update(skip_locked=True)
+            ids = list(candidates.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return []
+            claim = get_random_string(32)
+            due.filter(id__in=ids).update(status=self.model.STATUS_SENDING, claim=claim,
+                                          next_attempt=now + datetime.timedelta(seconds=lease_secs))
+        return list(self.filter(claim=claim, status=self.model.STATUS_SENDING))
+
+    @query_budget(1)
+    def mark_sent(self, ids, claim):
+        """Mark the rows of one claimed batch sent; returns how many were still held by ``claim``.
+
+        A row whose lease lapsed and was claimed again belongs to the other worker now,
+        and is left alone.
+        """
+        return self._claimed(ids, claim).update(status=self.model.STATUS_SENT, claim=None, last_error=None,
+                                                attempts=models.F('attempts') + 1, sent=timezone.now())
+
+    @query_budget(1)
+    def mark_failed(self, outbound, error, max_attempts, backoff_secs):
+        """Schedule a retry with backoff, or give up; returns 0 if the worker lost the lease."""
+        attempts = outbound.attempts + 1
+        if attempts >= max_attempts:
+            status, next_attempt = self.model.STATUS_FAILED, timezone.now()
+        else:
+            delay = backoff_secs * 2 ** (attempts - 1)
+            status, next_attempt = self.model.STATUS_PENDING, timezone.now() + datetime.timedelta(seconds=delay)
+        return self._claimed([outbound.id], outbound.claim).update(status=status, claim=None, attempts=attempts,
+                                                                   last_error=str(error), next_attempt=next_attempt)
+
+    def _claimed(self, ids, claim):
+        return self.filter(id__in=ids, claim=claim, status=self.model.STATUS_SENDING)
+
+    @query_budget(1)
+    def queue_depth(self):
+        return self.filter(status__in=(self.model.STATUS_PENDING, self.model.STATUS_SENDING)).count()
+
+    @query_budget(1)
+    def throughput(self, window_secs):
+        since = timezone.now() - datetime.timedelta(seconds=window_secs)
+        return self.filter(sent__gte=since).count() / float(window_secs)
@@ -0,0 +1,125 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+from .queries import query_observer
+
+_current = contextvars.ContextVar('myapp_request_stats', default=None)
+
+
+class Histogram:
+    """Prometheus-style histogram keyed by a tuple of label values.
+
+    Not locked itself: RequestMetrics observes all of a request's histograms under one lock.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self, label_names):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        for labels, (counts, total) in sorted(self._series.items()):
+            label_text = ','.join('{}="{}"'.format(name, value) for name, value in zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, label_text, '+Inf' if bound == float('inf') else repr(float(bound)), cumulative))
+            lines.append('{}_sum{{{}}} {!r}'.format(self.name, label_text, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label_text, cumulative))
+        return lines
+
+    def clear(self):
+        self._series.clear()
+
+
+class RequestStats:
+    """Queries of the request being handled, counted by ``count_queries`` on any thread."""
+    __slots__ = ('started', 'queries', 'query_time', '_token')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self._token = _current.set(self)
+        self.started = time.perf_counter()
+
+
+class RequestMetrics:
+    """Latency, query count, query time and response size per (view, status) pair."""
+    label_names = ('view', 'status')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.duration = Histogram('myapp_request_duration_seconds', 'Time spent handling the request.',
+                                  (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+        self.queries = Histogram('myapp_request_queries', 'Database queries made by the request.',
+                                 (0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+        self.query_time = Histogram('myapp_request_query_seconds', 'Time spent in database queries.',
+                                    (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+        self.response_size = Histogram('myapp_response_bytes', 'Size of the response body.',
+                                       (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+
+    def begin(self):
+        return RequestStats()
+
+    def end(self, stats, view, status, response):
+        duration = time.perf_counter() - stats.started
+        _current.reset(stats._token)
+        if response is not None and response.streaming:
+            # The size is only known once the body has been sent.
+            response.streaming_content = self._counted(response.streaming_content, stats, view, status, duration)
+        else:
+            self.observe(view, status, duration, stats, len(response.content) if response is not None else 0)
+
+    def _counted(self, content, stats, view, status, duration):
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.observe(view, status, duration, stats, size)
+
+    def observe(self, view, status, duration, stats, size):
+        labels = (view, status)
+        with self._lock:
+            self.duration.observe(labels, duration)
+            self.queries.observe(labels, stats.queries)
+            self.query_time.observe(labels, stats.query_time)
+            self.response_size.observe(labels, size)
+
+    def render(self):
+        """All histograms in the Prometheus text exposition format (0.0.4)."""
+        lines = []
+        with self._lock:
+            for histogram in (self.duration, self.queries, self.query_time, self.response_size):
+                lines.extend(histogram.render(self.label_names))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            for histogram in (self.duration, self.queries, self.query_time, self.response_size):
+                histogram.clear()
+
+
+request_metrics = RequestMetrics()
+
+
+@query_observer
+def count_queries(sql, params, seconds):
+    """Charges queries to the current request, if it is being measured."""
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_time += seconds
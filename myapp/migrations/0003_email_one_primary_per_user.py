@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 21:04
+
+from django.db import migrations, models
+
+
+def demote_duplicate_primaries(apps, schema_editor):
+    # Keep the most recently added primary email of each user.
+    Email = apps.get_model('myapp', 'Email')
+    emails = Email.objects.using(schema_editor.connection.alias)
+    duplicated = (emails.filter(is_primary=True).values('user_id')
+                  .annotate(n=models.Count('id'), keep=models.Max('id')).filter(n__gt=1))
+    for row in duplicated:
+        emails.filter(user_id=row['user_id'], is_primary=True).exclude(id=row['keep']).update(is_primary=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0002_outboundemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(demote_duplicate_primaries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='email',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_primary', True)), fields=('user',), name='myapp_email_one_primary_per_user'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_email_one_primary_per_user'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailconfirmation',
+            name='sent',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
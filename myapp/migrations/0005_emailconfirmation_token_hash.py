@@ -0,0 +1,45 @@
+from django.db import migrations, models
+from django.utils.crypto import salted_hmac
+
+
+def hash_confirmation_token(user_id, token):
+    # Frozen copy of myapp.models.hash_confirmation_token as of this migration.
+    return salted_hmac('myapp.EmailConfirmation', '{}:{}'.format(user_id, token)).hexdigest()
+
+
+def hash_tokens(apps, schema_editor):
+    EmailConfirmation = apps.get_model('myapp', 'EmailConfirmation')
+    confirmations = EmailConfirmation.objects.using(schema_editor.connection.alias)
+    pending = confirmations.filter(token_hash__isnull=True).order_by('id')
+    while True:
+        batch = list(pending.only('id', 'token', 'email__user_id').select_related('email')[:1000])
+        if not batch:
+            break
+        for confirmation in batch:
+            confirmation.token_hash = hash_confirmation_token(confirmation.email.user_id, confirmation.token)
+        confirmations.bulk_update(batch, ['token_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_emailconfirmation_sent_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailconfirmation',
+            name='token_hash',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.RunPython(hash_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='emailconfirmation',
+            name='token_hash',
+            field=models.CharField(max_length=40, unique=True),
+        ),
+        migrations.RemoveField(
+            model_name='emailconfirmation',
+            name='token',
+        ),
+    ]
@@ -0,0 +1,49 @@
+from django.db import migrations, models
+from django.db.models.functions import Lower, Trim
+
+
+def check_normalized_collisions(apps, schema_editor):
+    # Runs before any schema change (MySQL cannot roll DDL back), so a failure leaves the table as it was.
+    Email = apps.get_model('myapp', 'Email')
+    emails = Email.objects.using(schema_editor.connection.alias).annotate(normalized=Lower(Trim('address')))
+    collisions = list(emails.values('normalized').annotate(n=models.Count('id')).filter(n__gt=1)
+                      .order_by('normalized').values_list('normalized', flat=True)[:50])
+    if not collisions:
+        return
+    rows = emails.filter(normalized__in=collisions).order_by('normalized', 'id').values_list(
+        'normalized', 'id', 'user_id', 'address')
+    raise RuntimeError(
+        "Emails whose addresses differ only in case or surrounding whitespace must be merged or deleted "
+        "before address_normalized can be made unique (at most 50 addresses listed):\n{}".format(
+            '\n'.join('  {}: id={} user_id={} address={!r}'.format(*row) for row in rows)))
+
+
+def backfill_address_normalized(apps, schema_editor):
+    # Same canonical form as EmailManager.normalize_address, applied one id range at a time.
+    Email = apps.get_model('myapp', 'Email')
+    emails = Email.objects.using(schema_editor.connection.alias)
+    last_id = emails.aggregate(last_id=models.Max('id'))['last_id'] or 0
+    for start in range(0, last_id, 1000):
+        emails.filter(id__gt=start, id__lte=start + 1000).update(address_normalized=Lower(Trim('address')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_emailconfirmation_token_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_normalized_collisions, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='email',
+            name='address_normalized',
+            field=models.EmailField(editable=False, max_length=254, null=True, verbose_name='address_normalized'),
+        ),
+        migrations.RunPython(backfill_address_normalized, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='email',
+            name='address_normalized',
+            field=models.EmailField(editable=False, max_length=254, unique=True, verbose_name='address_normalized'),
+        ),
+    ]
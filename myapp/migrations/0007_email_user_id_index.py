@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-17 21:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_email_address_normalized'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['user', 'id'], name='myapp_email_user_id_c2240f_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-17 21:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0007_email_user_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['user', 'is_primary', 'is_verified'], name='myapp_email_user_id_6ae070_idx'),
+        ),
+    ]
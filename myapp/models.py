@@ -2,10 +2,14 @@ import datetime
 import time
 
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
+from django.utils.crypto import get_random_string, salted_hmac
 
-from .managers import EmailManager, EmailConfirmationManager
+from .budgets import query_budget
+from .caching import email_list_cache, primary_email_cache
+from .emails import confirmation_renderer
+from .managers import EmailManager, EmailConfirmationManager, OutboundEmailManager
 #  from brickly.utils.crypto import Crypto  #未提供
 #  from brickly.utils.logger import Logger  #未提供
 
@@ -14,6 +18,7 @@ from .managers import EmailManager, EmailConfirmationManager
 
 class Email(models.Model):
     address = models.EmailField('address')
+    address_normalized = models.EmailField('address_normalized', unique=True, editable=False)
     is_verified = models.BooleanField("is_verified", default=False)
     is_primary = models.BooleanField("is_primary", default=False)
     label = models.CharField('label', max_length=255, blank=True, null=True)
@@ -25,6 +30,11 @@ class Email(models.Model):
         verbose_name = "email"
         verbose_name_plural = "emails"
         unique_together = [("user", "address")]
+        indexes = [models.Index(fields=['user', 'id']), models.Index(fields=['user', 'is_primary', 'is_verified'])]
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=models.Q(is_primary=True),
+                                    name='myapp_email_one_primary_per_user'),
+        ]
 
     def __init__(self, *args, **kwargs):
         super(Email, self).__init__(*args, **kwargs)
@@ -33,15 +43,25 @@ class Email(models.Model):
     def __str__(self):
         return "{0} ({1})".format(self.address, self.user)
 
+    def save(self, *args, **kwargs):
+        self.address_normalized = Email.objects.normalize_address(self.address)
+        super(Email, self).save(*args, **kwargs)
+
+    @query_budget(3)
     def set_as_primary(self):
-        emails = Email.objects.filter(user=self.user).filter(is_primary=True).exclude(address=self.address).all()
-        for email in emails:
-            email.is_primary = False
-            email.save()
+        user_field = self._meta.get_field('user')
+        user_model = user_field.remote_field.model
+        with transaction.atomic():
+            # Updating the user row first takes its row lock, so concurrent switches for the
+            # same user are serialized; the constraint below backs this up at the schema level.
+            user_model.objects.filter(pk=self.user_id).update(email=self.address)
+            Email.objects.filter(user_id=self.user_id, is_primary=True).exclude(pk=self.pk).update(is_primary=False)
+            Email.objects.filter(pk=self.pk).update(is_primary=True, is_verified=self.is_verified)
+            email_list_cache.invalidate(self.user_id)
+            primary_email_cache.invalidate(self.user_id)
         self.is_primary = True
-        self.save()
-        self.user.set_email(self.address)
-        self.user.save()
+        if user_field.is_cached(self):
+            self.user.email = self.address
         return True
 
     def verify(self):
@@ -52,21 +72,61 @@ class Email(models.Model):
             self.save()
         return self
 
-    #  def create_confirmation(self, digits):
-        #  code = None
-        #  while True:
-            #  code = Crypto.get_random_string(length=digits, allowed_chars=r'0123456789')
-            #  email_ids = Email.objects.filter(user=self.user).values_list('id', flat=True)
-            #  if not EmailConfirmation.objects.filter(token=code, email_id__in=email_ids).exists():
-                #  break
-        #  defaults = {'token': code}
-        #  return EmailConfirmation.objects.get_or_create(email=self, defaults=defaults)[0]
+    @query_budget(4)  # delete + insert, plus room for a retry or two on a code collision
+    def create_confirmation(self, digits):
+        # A new code replaces any pending one; only its hash is stored, so the plain code
+        # is handed back on the returned instance's ``token`` attribute.
+        EmailConfirmation.objects.filter(email=self).delete()
+        while True:
+            code = get_random_string(length=digits, allowed_chars=r'0123456789')
+            try:
+                with transaction.atomic():
+                    confirmation = EmailConfirmation.objects.create(
+                        email=self, token_hash=hash_confirmation_token(self.user_id, code), sent=timezone.now())
+            except IntegrityError:
+                # The user already has a pending confirmation with this code.
+                continue
+            confirmation.token = code
+            return confirmation
+
+
+    @query_budget(5)  # create_confirmation, plus the outbox row
+    def send_confirmation(self, user, extra_context=None):
+        """Replace any pending code with a new one and queue the email carrying it, in user's language."""
+        from .mailer import enqueue_mail  # mailer imports this module
+
+        context = {
+            'website_url': settings.WEBSITE['url'],
+            'support_url': settings.WEBSITE['support_url'],
+            'first_name': user.first_name,
+            'operating_system': '',
+            'browser_name': '',
+        }
+        context.update(extra_context or {})
+        with transaction.atomic():
+            self.confirmation = self.create_confirmation(settings.WEBSITE['confirmation_digits'])
+            context['token'] = self.confirmation.token
+            language = getattr(user, 'language', settings.LANGUAGE_CODE)
+            subject, text, html = confirmation_renderer.render(context, language)
+            enqueue_mail(
+                subject=subject,
+                message=text,
+                from_email=settings.WEBSITE['support_email'],
+                recipient_list=(self.address,),
+                html_message=html,
+            )
+        return self.confirmation
+
+
+def hash_confirmation_token(user_id, token):
+    """Fixed-length keyed hash of a confirmation code, scoped to its user."""
+    return salted_hmac('myapp.EmailConfirmation', '{}:{}'.format(user_id, token)).hexdigest()
 
 
 class EmailConfirmation(models.Model):
     created = models.DateTimeField(default=timezone.now)
-    sent = models.DateTimeField(null=True)
-    token = models.CharField(max_length=64, unique=True)
+    sent = models.DateTimeField(null=True, db_index=True)
+    token_hash = models.CharField(max_length=40, unique=True)
     email = models.ForeignKey(Email, on_delete=models.CASCADE)
 
     objects = EmailConfirmationManager()
@@ -75,18 +135,22 @@ class EmailConfirmation(models.Model):
         verbose_name = "email confirmation"
         verbose_name_plural = "email confirmations"
 
+    def __init__(self, *args, **kwargs):
+        super(EmailConfirmation, self).__init__(*args, **kwargs)
+        self.token = None
+
     def __str__(self):
         return "confirmation for {0}".format(self.email)
 
     @classmethod
+    @query_budget(1)
     def get_checked(cls, user, token, confirm_expire_secs):
+        cutoff = timezone.now() - datetime.timedelta(seconds=confirm_expire_secs)
         try:
-            email_ids = Email.objects.filter(user=user).values_list('id', flat=True)
-            record = cls.objects.get(token=token, email_id__in=email_ids)
+            return cls.objects.select_related('email').get(token_hash=hash_confirmation_token(user.pk, token),
+                                                           email__user=user, sent__gt=cutoff)
         except cls.DoesNotExist:
             return None
-        else:
-            return None if record.token_expired(confirm_expire_secs) else record
 
     def token_expired(self, confirm_expire_secs):
         expiration_date = self.sent + datetime.timedelta(seconds=confirm_expire_secs)
@@ -95,3 +159,41 @@ class EmailConfirmation(models.Model):
     token_expired.boolean = True
 
 
+class OutboundEmail(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'pending'),
+        (STATUS_SENDING, 'sending'),
+        (STATUS_SENT, 'sent'),
+        (STATUS_FAILED, 'failed'),
+    )
+
+    subject = models.CharField('subject', max_length=255)
+    body = models.TextField('body')
+    html_body = models.TextField('html_body', blank=True, null=True)
+    from_email = models.CharField('from_email', max_length=255)
+    recipients = models.TextField('recipients')
+    status = models.CharField('status', max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField('attempts', default=0)
+    last_error = models.TextField('last_error', blank=True, null=True)
+    claim = models.CharField('claim', max_length=32, blank=True, null=True, db_index=True)
+    created = models.DateTimeField(default=timezone.now)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True, db_index=True)
+
+    objects = OutboundEmailManager()
+
+    class Meta:
+        verbose_name = "outbound email"
+        verbose_name_plural = "outbound emails"
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+
+    def __str__(self):
+        return "{0} to {1} ({2})".format(self.subject, self.recipients, self.status)
+
+    @property
+    def recipient_list(self):
+        return [address for address in self.recipients.split(',') if address]
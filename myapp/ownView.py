@@ -1,16 +1,27 @@
-import json
+import asyncio
+import functools
+import math
 import os
 
+from asgiref.sync import sync_to_async
+
 from django.conf import settings
 from django.core.validators import validate_email, ValidationError
 from django.http import Http404, FileResponse
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
 from django.utils.translation import ugettext as _
-from rest_framework import permissions
-from rest_framework.utils.encoders import JSONEncoder
+from rest_framework import exceptions, permissions
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication
 from rest_framework.views import APIView
 
+from .budgets import QueryBudget
 from .datetime import Datetime
+from .encoders import get_envelope_encoder
+from .metrics import request_metrics
+from .routers import is_pinned, pin_to_primary, use_replicas
+from .throttling import AddressTokenBucketThrottle, UserTokenBucketThrottle, check_throttles
+from .tokens import SignedTokenAuthentication, make_token
 
 
 class StatusCode:
@@ -35,6 +46,7 @@ class StatusCode:
     ERROR_VALIDATION = 410
     ERROR_NOT_SUPPORTED = 415
     ERROR_NOT_SATISFIABLE = 416
+    ERROR_TOO_MANY_REQUESTS = 429
 
     SERVER_ERROR = 500
     SERVER_ERROR_NOT_IMPLEMENTED = 501
@@ -61,6 +73,7 @@ class StatusCode:
         ERROR_VALIDATION: 'error_validation',
         ERROR_NOT_SUPPORTED: 'error_not_supported',
         ERROR_NOT_SATISFIABLE: 'error_not_satisfiable',
+        ERROR_TOO_MANY_REQUESTS: 'error_too_many_requests',
 
         SERVER_ERROR: 'server_error',
         SERVER_ERROR_NOT_IMPLEMENTED: 'server_error_not_implemented',
@@ -68,9 +81,10 @@ class StatusCode:
 
 
 class RestViewError(Exception):
-    def __init__(self, status_code, err_msg):
+    def __init__(self, status_code, err_msg, result=None):
         self._status_code = status_code
         self._err_msg = err_msg
+        self._result = result
         super(RestViewError, self).__init__(err_msg)
 
     @property
@@ -81,210 +95,538 @@ class RestViewError(Exception):
     def err_msg(self):
         return self._err_msg
 
+    @property
+    def result(self):
+        return self._result
+
 
 class InvalidArgumentError(RestViewError):
-    def __init__(self, err_msg):
-        super(InvalidArgumentError, self).__init__(StatusCode.ERROR, err_msg)
+    def __init__(self, err_msg, result=None):
+        super(InvalidArgumentError, self).__init__(StatusCode.ERROR, err_msg, result)
 
 
 class MissingArgumentError(InvalidArgumentError):
     pass
 
 
+class InvalidParamsError(InvalidArgumentError):
+    """Every parameter of a view's schema that failed, as ``{"errors": {name: message}}``."""
+
+    def __init__(self, errors):
+        if len(errors) == 1:
+            err_msg = next(iter(errors.values()))
+        else:
+            err_msg = "Please correct the invalid parameters: {}".format(', '.join(errors))
+        super(InvalidParamsError, self).__init__(err_msg, {'errors': errors})
+        self.errors = errors
+
+
+def parse_email(value):
+    """Validate an email address and lowercase its domain; raises ValidationError."""
+    validate_email(value)
+    email_name, domain_part = value.strip().rsplit('@', 1)
+    return '@'.join([email_name, domain_part.lower()])
+
+
+class Param:
+    """One request parameter of a RestView ``params`` schema.
+
+    ``convert`` turns the raw value into the handler's value or raises ValueError;
+    the subclasses share their converters with the ``RestView.get_*_param`` helpers.
+    """
+    err_msg = "Please enter a valid value"
+
+    def __init__(self, err_msg=None, default=None, required=True):
+        if err_msg is not None:
+            self.err_msg = err_msg
+        self.default = default
+        self.required = required
+
+    def convert(self, value):
+        return value
+
+
+class JsonParam(Param):
+    err_msg = "Please enter a valid structure"
+
+    def __init__(self, expected_type, *args, **kwargs):
+        super(JsonParam, self).__init__(*args, **kwargs)
+        self.expected_type = expected_type
+
+    def convert(self, value):
+        if not isinstance(value, self.expected_type):
+            raise ValueError(value)
+        return value
+
+
+class StringParam(Param):
+    err_msg = "Please enter a valid string"
+
+    def convert(self, value):
+        if not isinstance(value, str):
+            raise ValueError(value)
+        return value
+
+
+class DateParam(Param):
+    err_msg = "Please enter a valid date"
+
+    def __init__(self, *args, detail=False, **kwargs):
+        super(DateParam, self).__init__(*args, **kwargs)
+        self.fmt = '%Y-%m-%d %H:%M:%S.%f' if detail else '%Y-%m-%d'
+
+    def convert(self, value):
+        try:
+            return Datetime.strptime(value, self.fmt)
+        except TypeError:
+            raise ValueError(value)
+
+
+class BoolParam(Param):
+    err_msg = "Please enter a valid boolean flag"
+
+    def convert(self, value):
+        if type(value) is bool:
+            return value
+        if not isinstance(value, str):
+            raise ValueError(value)
+        return value.lower() in ("yes", "true", "1")
+
+
+class IntParam(Param):
+    err_msg = "Please enter a valid integer"
+
+    def convert(self, value):
+        if isinstance(value, int):
+            return value
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError(value)
+
+
+class EmailParam(Param):
+    err_msg = "Please enter a valid email"
+
+    def convert(self, value):
+        try:
+            return parse_email(value)
+        except (ValidationError, AttributeError, TypeError):
+            raise ValueError(value)
+
+
+class PhoneParam(Param):
+    err_msg = "Please enter a valid phone number"
+
+    def convert(self, value):
+        if not isinstance(value, str):
+            raise ValueError(value)
+        return value.strip()
+
+
+class VerificationCodeParam(Param):
+    err_msg = "Please enter a valid verification code"
+
+    def convert(self, value):
+        if not isinstance(value, str) or len(value) != 4:
+            raise ValueError(value)
+        return value
+
+
+def compile_params(schema):
+    """Build a single-pass extractor for ``{name: Param}``.
+
+    The extractor reads each name from the request body, falling back to the query
+    string, converts it, and raises InvalidParamsError listing every failure.
+    """
+    fields = tuple((name, param.convert, param.required, param.default, param.err_msg)
+                   for name, param in schema.items())
+    missing = object()
+
+    def extract(request):
+        data, query = request.data, request.query_params
+        values, errors = {}, None
+        for name, convert, required, default, err_msg in fields:
+            value = data.get(name, missing)
+            if value is missing:
+                value = query.get(name, missing)
+            if value is missing:
+                if required:
+                    errors = errors or {}
+                    errors[name] = err_msg
+                else:
+                    values[name] = default
+                continue
+            try:
+                values[name] = convert(value)
+            except ValueError:
+                errors = errors or {}
+                errors[name] = err_msg
+        if errors:
+            raise InvalidParamsError(errors)
+        return values
+
+    return extract
+
+
 class RestView(APIView):
+    # Bearer tokens first: they are checked without the session or a user query (see myapp.tokens).
+    authentication_classes = (SignedTokenAuthentication, SessionAuthentication, BasicAuthentication)
     permission_classes = (permissions.IsAuthenticated,)
-
-    def __init__(self):
-        super(RestView, self).__init__()
+    # Purposes of the signed tokens this view accepts.
+    token_purposes = ('api',)
+    # True for GET handlers that never write: their reads may go to a replica (see myapp.routers).
+    read_only = False
+    # Token-bucket limits per scope, e.g. {'user': '10/min', 'address': '3/min'}; see myapp.throttling.
+    throttle_classes = (UserTokenBucketThrottle, AddressTokenBucketThrottle)
+    token_buckets = None
+    # Most queries the handler may make, or None; see myapp.budgets.
+    query_budget = None
+    # Declarative parameters: {name: Param}. Compiled once per class; the handler
+    # finds the converted values in ``self.params``.
+    param_schema = None
+    _extract_params = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._extract_params = staticmethod(compile_params(cls.param_schema)) if cls.param_schema else None
+
+    def __init__(self, **kwargs):
+        super(RestView, self).__init__(**kwargs)
         self._request = None
         self._user = None
+        self.params = {}
+
+    def dispatch(self, request, *args, **kwargs):
+        if not settings.METRICS['enabled']:
+            return super(RestView, self).dispatch(request, *args, **kwargs)
+        stats = request_metrics.begin()
+        response = None
+        try:
+            response = super(RestView, self).dispatch(request, *args, **kwargs)
+            return response
+        finally:
+            self._record_metrics(stats, response)
+
+    def _record_metrics(self, stats, response):
+        status_code = response.status_code if response is not None else StatusCode.SERVER_ERROR
+        request_metrics.end(stats, type(self).__name__, StatusCode.names.get(status_code, str(status_code)), response)
+
+    def check_throttles(self, request):
+        waits = check_throttles(self.get_throttles(), request, self)
+        if waits:
+            waits = [wait for wait in waits if wait is not None]
+            self.throttled(request, max(waits) if waits else None)
 
     def handle_exception(self, exc):
+        if isinstance(exc, exceptions.Throttled):
+            response = self.error(StatusCode.ERROR_TOO_MANY_REQUESTS, _('Too many requests, please try again later'))
+            if exc.wait is not None:
+                response['Retry-After'] = str(int(math.ceil(exc.wait)))
+            return response
         response = super(RestView, self).handle_exception(exc)
-        if response.status_code == 403:
-            return self.error(StatusCode.ERROR_UNAUTHORIZED, _('Access denied'))
+        if response.status_code in (401, 403):
+            error = self.error(StatusCode.ERROR_UNAUTHORIZED, _('Access denied'))
+            if response.has_header('WWW-Authenticate'):
+                error['WWW-Authenticate'] = response['WWW-Authenticate']
+            return error
         return response
 
-    def get_json_param(self, name, expected_type,
-                       err_msg="Please enter a valid structure",
-                       default=None, required=True):
+    def _param(self, name, param):
         if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
+            if param.required:
+                raise MissingArgumentError(param.err_msg)
+            return param.default
 
         value = self._request.data.get(name, self._request.query_params.get(name))
-        if not isinstance(value, expected_type):
-            raise InvalidArgumentError(err_msg)
-        return value
+        try:
+            return param.convert(value)
+        except ValueError:
+            raise InvalidArgumentError(param.err_msg)
+
+    def get_json_param(self, name, expected_type,
+                       err_msg="Please enter a valid structure",
+                       default=None, required=True):
+        return self._param(name, JsonParam(expected_type, err_msg, default, required))
 
     def get_string_param(self, name,
                          err_msg="Please enter a valid string",
                          default=None, required=True):
-        if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
-
-        value = self._request.data.get(name, self._request.query_params.get(name))
-        if not isinstance(value, str):
-            raise InvalidArgumentError(err_msg)
-        return value
+        return self._param(name, StringParam(err_msg, default, required))
 
     def get_date_param(self, name,
                        err_msg="Please enter a valid date",
                        default=None, required=True, detail=False):
-        if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
-
-        value = self._request.data.get(name, self._request.query_params.get(name))
-
-        try:
-            return Datetime.strptime(value, '%Y-%m-%d') if not detail else Datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
-        except ValueError:
-            raise InvalidArgumentError(err_msg)
+        return self._param(name, DateParam(err_msg, default, required, detail=detail))
 
     def get_bool_param(self, name,
                        err_msg="Please enter a valid boolean flag",
                        default=None, required=True):
-        if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
-
-        value = self._request.data.get(name, self._request.query_params.get(name))
-        if type(value) is not bool:
-            value = value.lower() in ("yes", "true", "1")
-        if not isinstance(value, bool):
-            raise InvalidArgumentError(err_msg)
-        return value
+        return self._param(name, BoolParam(err_msg, default, required))
 
     def get_int_param(self, name,
                       err_msg="Please enter a valid integer",
                       default=None, required=True):
-        if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
-
-        value = self._request.data.get(name, self._request.query_params.get(name))
-        if not isinstance(value, int):
-            try:
-                value = int(value)
-            except:
-                raise InvalidArgumentError(err_msg)
-        return value
+        return self._param(name, IntParam(err_msg, default, required))
 
     def get_email_param(self, name,
                         err_msg="Please enter a valid email",
                         default=None, required=True):
-        if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
-
-        try:
-            value = self._request.data.get(name, self._request.query_params.get(name))
-            validate_email(value)
-            email_name, domain_part = value.strip().rsplit('@', 1)
-            return '@'.join([email_name, domain_part.lower()])
-        except ValidationError:
-            raise InvalidArgumentError(err_msg)
+        return self._param(name, EmailParam(err_msg, default, required))
 
     def get_phone_param(self, name,
                         err_msg="Please enter a valid phone number",
                         default=None, required=True):
-        if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
-
-        value = self._request.data.get(name, self._request.query_params.get(name))
-        phone_number = value.strip()
-        return phone_number
+        return self._param(name, PhoneParam(err_msg, default, required))
 
     def get_verification_code(self, name,
                               err_msg="Please enter a valid verification code",
                               default=None, required=True):
-        if name not in self._request.data and name not in self._request.query_params:
-            if required:
-                raise MissingArgumentError(err_msg)
-            return default
-
-        code = self._request.data.get(name, self._request.query_params.get(name))
-        if len(code) != 4:
-            raise InvalidArgumentError(err_msg)
-        return code
+        return self._param(name, VerificationCodeParam(err_msg, default, required))
 
     def _response(self, response):
         pass
 
     def _render_response(self, status_code, msg, result):
-        body = {
-            'status': StatusCode.names[status_code],
-            'message': msg,
-            'result': result,
-        }
-        http_response = HttpResponse(content=json.dumps(body, cls=JSONEncoder),
-                                     content_type='application/json',
-                                     status=status_code)
+        encoder = get_envelope_encoder()
+        status_name = StatusCode.names[status_code]
+        if isinstance(result, list) and len(result) >= settings.REST_VIEW['stream_threshold']:
+            http_response = StreamingHttpResponse(encoder.iter_encode(status_name, msg, result),
+                                                  content_type='application/json',
+                                                  status=status_code)
+        else:
+            http_response = HttpResponse(content=encoder.encode(status_name, msg, result),
+                                         content_type='application/json',
+                                         status=status_code)
+        self._response(http_response)
+        return http_response
+
+    def not_modified(self, etag):
+        http_response = HttpResponse(status=StatusCode.WARNING_NOT_MODIFIED)
+        http_response['ETag'] = etag
         self._response(http_response)
         return http_response
 
-    def error(self, status_code, msg):
+    def error(self, status_code, msg, result=None):
         assert StatusCode.ERROR <= status_code < StatusCode.SERVER_ERROR
-        return self._render_response(status_code, msg, None)
+        return self._render_response(status_code, msg, result)
 
     def success(self, result, msg=_('Success'), status_code=StatusCode.SUCCESS):
         assert StatusCode.SUCCESS <= status_code < StatusCode.WARNING
         return self._render_response(status_code, msg, result)
 
+    def _generate_token(self, purpose='api'):
+        """A signed token for the current user; see myapp.tokens.make_token."""
+        return make_token(self._user, purpose)
+
+    def _begin(self, request):
+        self._request = request
+        self._user = self._request.user
+        self.params = self._extract_params(request) if self._extract_params else {}
+
+    def _handle(self, handler):
+        with QueryBudget(type(self).__name__, self.query_budget):
+            if not settings.READ_REPLICAS['databases']:
+                return handler()
+
+            user_id = getattr(self._user, 'pk', None)
+            with use_replicas(self.read_only and self._request.method == 'GET' and not is_pinned(user_id)):
+                response = handler()
+        if not self.read_only and StatusCode.SUCCESS <= response.status_code < StatusCode.WARNING:
+            pin_to_primary(user_id)
+        return response
+
     def post(self, request):
         try:
-            self._request = request
-            self._user = self._request.user
-            return self._post()
+            self._begin(request)
+            return self._handle(self._post)
         except RestViewError as e:
-            return self.error(e.status_code, e.err_msg or str(e))
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
 
     def _post(self):
         return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
 
     def patch(self, request):
         try:
-            self._request = request
-            self._user = self._request.user
-            return self._patch()
+            self._begin(request)
+            return self._handle(self._patch)
         except RestViewError as e:
-            return self.error(e.status_code, e.err_msg or str(e))
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
 
     def _patch(self):
         return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
 
     def delete(self, request):
         try:
-            self._request = request
-            self._user = self._request.user
-            return self._delete()
+            self._begin(request)
+            return self._handle(self._delete)
         except RestViewError as e:
-            return self.error(e.status_code, e.err_msg or str(e))
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
 
     def _delete(self):
         return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
 
     def get(self, request):
         try:
-            self._request = request
-            self._user = self._request.user
-            return self._get()
+            self._begin(request)
+            etag = self.get_etag()
+            if etag is None:
+                return self._handle(self._get)
+
+            etag = quote_etag(etag)
+            if self._if_none_match(etag):
+                return self.not_modified(etag)
+            return self._tag(self._handle(self._get), etag)
         except RestViewError as e:
-            return self.error(e.status_code, e.err_msg or str(e))
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
 
     def _get(self):
         return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
 
+    def get_etag(self):
+        """Cheap validator for the GET response, computed before ``_get`` runs.
+
+        Return None (the default) to disable conditional GETs for the view.
+        """
+        return None
+
+    def _if_none_match(self, etag):
+        if_none_match = self._request.META.get('HTTP_IF_NONE_MATCH')
+        return bool(if_none_match) and self._etag_matches(etag, parse_etags(if_none_match))
+
+    @staticmethod
+    def _tag(response, etag):
+        if StatusCode.SUCCESS <= response.status_code < StatusCode.WARNING:
+            response['ETag'] = etag
+        return response
+
+    @staticmethod
+    def _etag_matches(etag, client_etags):
+        if '*' in client_etags:
+            return True
+        # If-None-Match uses the weak comparison.
+        etag = etag[2:] if etag.startswith('W/') else etag
+        return any((e[2:] if e.startswith('W/') else e) == etag for e in client_etags)
+
+
+class AsyncRestView(RestView):
+    """RestView for ASGI deployments: ``_get``/``_post``/``_patch``/``_delete`` may be coroutines.
+
+    Authentication, permission and throttle checks, ``get_etag`` and plain ``def``
+    handlers run in a worker thread through ``sync_to_async``, so the event loop keeps
+    serving other requests while they wait on the database; ``async def`` handlers must
+    wrap their own ORM calls the same way. Responses and error handling are RestView's.
+    Under WSGI, Django runs the view through ``async_to_sync``.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        sync_view = super(AsyncRestView, cls).as_view(**initkwargs)
+
+        async def view(request, *args, **kwargs):
+            self = cls(**initkwargs)
+            self.setup(request, *args, **kwargs)
+            return await self.dispatch(request, *args, **kwargs)
+
+        # Copies view_class, initkwargs and csrf_exempt from DRF's (synchronous) view.
+        return functools.update_wrapper(view, sync_view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        if not settings.METRICS['enabled']:
+            return await self._dispatch(request, *args, **kwargs)
+        stats = request_metrics.begin()
+        response = None
+        try:
+            response = await self._dispatch(request, *args, **kwargs)
+            return response
+        finally:
+            self._record_metrics(stats, response)
+
+    async def _dispatch(self, request, *args, **kwargs):
+        """APIView.dispatch, awaiting the handler and keeping the blocking checks off the event loop."""
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            method = request.method.lower()
+            handler = getattr(self, method, None) if method in self.http_method_names else None
+            response = (handler or self.http_method_not_allowed)(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def _handle_async(self, handler):
+        if not asyncio.iscoroutinefunction(handler):
+            handler = sync_to_async(handler)
+        if not settings.READ_REPLICAS['databases']:
+            with QueryBudget(type(self).__name__, self.query_budget):
+                return await handler()
+
+        user_id = getattr(self._user, 'pk', None)
+        pinned = await sync_to_async(is_pinned)(user_id)
+        with QueryBudget(type(self).__name__, self.query_budget), \
+                use_replicas(self.read_only and self._request.method == 'GET' and not pinned):
+            response = await handler()
+        if not self.read_only and StatusCode.SUCCESS <= response.status_code < StatusCode.WARNING:
+            await sync_to_async(pin_to_primary)(user_id)
+        return response
+
+    async def post(self, request):
+        try:
+            self._begin(request)
+            return await self._handle_async(self._post)
+        except RestViewError as e:
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
+
+    async def _post(self):
+        return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
+
+    async def patch(self, request):
+        try:
+            self._begin(request)
+            return await self._handle_async(self._patch)
+        except RestViewError as e:
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
+
+    async def _patch(self):
+        return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
+
+    async def delete(self, request):
+        try:
+            self._begin(request)
+            return await self._handle_async(self._delete)
+        except RestViewError as e:
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
+
+    async def _delete(self):
+        return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
+
+    async def get(self, request):
+        try:
+            self._begin(request)
+            # get_etag may hit the cache or database; skip the thread hop when it is not overridden.
+            etag = None if type(self).get_etag is RestView.get_etag else await sync_to_async(self.get_etag)()
+            if etag is None:
+                return await self._handle_async(self._get)
+
+            etag = quote_etag(etag)
+            if self._if_none_match(etag):
+                return self.not_modified(etag)
+            return self._tag(await self._handle_async(self._get), etag)
+        except RestViewError as e:
+            return self.error(e.status_code, e.err_msg or str(e), e.result)
+
+    async def _get(self):
+        return self.error(StatusCode.ERROR_NOT_SUPPORTED, 'not implemented')
+
 
 class EmptyView(RestView):
     authentication_classes = ()
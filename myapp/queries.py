@@ -0,0 +1,33 @@
+import time
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+_observers = []
+
+
+def query_observer(func):
+    """Register ``func(sql, params, seconds)`` to be called after every database query.
+
+    Observers run on the thread that made the query, including for queries that
+    fail, and should return at once when there is nothing to record.
+    """
+    _observers.append(func)
+    return func
+
+
+def observe_queries(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - started
+        for observer in _observers:
+            observer(sql, params, seconds)
+
+
+@receiver(connection_created)
+def install_query_observer(sender, connection, **kwargs):
+    # Wrappers live on the DatabaseWrapper, which survives reconnects.
+    if observe_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(observe_queries)
@@ -0,0 +1,59 @@
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+_use_replicas = contextvars.ContextVar('myapp_use_replicas', default=False)
+
+
+class ReplicaRouter:
+    """Send reads made inside ``use_replicas()`` to a random READ_REPLICAS database.
+
+    Everything else, including all writes, goes to ``default``. RestView enables
+    replicas only for read-only GET handlers of users that have not written within
+    READ_REPLICAS['sticky_secs'], so users always read their own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replicas.get():
+            replicas = settings.READ_REPLICAS['databases']
+            if replicas:
+                return random.choice(replicas)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+
+@contextmanager
+def use_replicas(enabled=True):
+    token = _use_replicas.set(enabled)
+    try:
+        yield
+    finally:
+        _use_replicas.reset(token)
+
+
+def _pin_key(user_id):
+    return 'myapp:db_pin:{}'.format(user_id)
+
+
+def pin_to_primary(user_id):
+    """Keep ``user_id``'s reads on the primary until replicas have caught up with its write."""
+    sticky_secs = settings.READ_REPLICAS['sticky_secs']
+    if user_id is not None and sticky_secs and settings.READ_REPLICAS['databases']:
+        caches[settings.READ_REPLICAS['cache']].set(_pin_key(user_id), time.time() + sticky_secs, sticky_secs)
+
+
+def is_pinned(user_id):
+    if user_id is None:
+        return False
+    until = caches[settings.READ_REPLICAS['cache']].get(_pin_key(user_id))
+    return until is not None and until > time.time()
@@ -1,3 +1,6 @@
+from operator import attrgetter
+
+from django.db.models import QuerySet
 from rest_framework import serializers
 
 from .models import Email
@@ -13,3 +16,32 @@ class EmailSerializer(serializers.ModelSerializer):
             'is_primary',
             'label',
         )
+
+
+class EmailReadSerializer:
+    """Read-only, low-overhead counterpart of EmailSerializer.
+
+    Produces the same dicts, but reads querysets with ``values_list`` so no model
+    instances or per-row field objects are created. Accepts a queryset, a single
+    Email, or an iterable of Emails, like ``EmailSerializer(..., many=...)``.
+    """
+    fields = EmailSerializer.Meta.fields
+
+    def __init__(self, instance=None, many=False):
+        self.instance = instance
+        self.many = many
+
+    @property
+    def data(self):
+        fields = self.fields
+        if not self.many:
+            return self.to_representation(self.instance)
+        if isinstance(self.instance, QuerySet):
+            return [dict(zip(fields, row)) for row in self.instance.values_list(*fields)]
+        return [self.to_representation(email) for email in self.instance]
+
+    def to_representation(self, email):
+        return dict(zip(self.fields, _email_getter(email)))
+
+
+_email_getter = attrgetter(*EmailReadSerializer.fields)
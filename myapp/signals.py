@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import email_list_cache, primary_email_cache
+from .models import Email
+from .tokens import verified_users
+
+
+@receiver(post_save, sender=Email)
+@receiver(post_delete, sender=Email)
+def invalidate_email_caches(sender, instance, **kwargs):
+    email_list_cache.invalidate(instance.user_id)
+    primary_email_cache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def discard_verified_user(sender, instance, **kwargs):
+    verified_users.discard(instance.pk)
@@ -0,0 +1,58 @@
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.urls import URLResolver, get_resolver
+
+logger = logging.getLogger(__name__)
+
+# Seconds taken by each step of the last warmup() in this process.
+last_warmup = OrderedDict()
+
+
+def warm_url_resolver():
+    """Import the URLconf and its views and compile every pattern, as the first request would."""
+    resolver = get_resolver()
+    pending = [resolver]
+    while pending:
+        for pattern in pending.pop().url_patterns:
+            pattern.pattern.regex
+            if isinstance(pattern, URLResolver):
+                pending.append(pattern)
+    resolver.reverse_dict
+
+
+def warm_drf_settings():
+    """Resolve DRF's settings, importing the renderer, parser and other classes they name."""
+    from rest_framework.settings import api_settings
+
+    for name in api_settings.defaults:
+        getattr(api_settings, name)
+
+
+def warm_confirmation_templates():
+    """Compile the confirmation email templates for STARTUP['languages']."""
+    from .emails import confirmation_renderer
+
+    for language in settings.STARTUP['languages'] or [settings.LANGUAGE_CODE]:
+        confirmation_renderer.templates(language)
+
+
+steps = OrderedDict([
+    ('url resolver', warm_url_resolver),
+    ('drf settings', warm_drf_settings),
+    ('confirmation templates', warm_confirmation_templates),
+])
+
+
+def warmup():
+    """Run every warmup step; returns and records ``{step: seconds}``."""
+    last_warmup.clear()
+    for name, step in steps.items():
+        started = time.perf_counter()
+        step()
+        last_warmup[name] = time.perf_counter() - started
+    logger.info('Warmed up in %.3fs (%s)', sum(last_warmup.values()),
+                ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in last_warmup.items()))
+    return last_warmup
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """DiscoverRunner that fails any test going over a query budget (see myapp.budgets)."""
+
+    def setup_test_environment(self, **kwargs):
+        super(TestRunner, self).setup_test_environment(**kwargs)
+        self._query_budgets = settings.QUERY_BUDGETS
+        settings.QUERY_BUDGETS = dict(self._query_budgets, **{'raise': True})
+
+    def teardown_test_environment(self, **kwargs):
+        settings.QUERY_BUDGETS = self._query_budgets
+        super(TestRunner, self).teardown_test_environment(**kwargs)
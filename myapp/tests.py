@@ -1,3 +1,1134 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import smtplib
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.db import DatabaseError, IntegrityError, connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import startup
+from .benchmarks import compare
+from .budgets import QueryBudget, QueryBudgetExceeded, query_budget
+from .caching import EmailListCache, email_list_cache, primary_email_cache
+from .checks import check_email_list_cache
+from .datetime import Datetime
+from .emails import EmailRenderer, confirmation_renderer
+from .encoders import EnvelopeEncoder, StdlibJSONBackend
+from .mailer import OutboxWorker, enqueue_mail
+from .metrics import request_metrics
+from .models import Email, EmailConfirmation, OutboundEmail, hash_confirmation_token
+from .ownView import (AsyncRestView, BoolParam, EmailParam, IntParam, InvalidArgumentError, RestView, StatusCode,
+                      StringParam)
+from .routers import ReplicaRouter, use_replicas
+from .serializers import EmailReadSerializer, EmailSerializer
+from .throttling import TokenBucket, token_bucket
+from .tokens import InvalidToken, check_token, make_token, user_fingerprint, verified_users
+from .views import EmailBatch
+
+
+class FailingEmailBackend(LocmemEmailBackend):
+    def send_messages(self, messages):
+        raise smtplib.SMTPServerDisconnected('relay went away')
+
+
+class LeaseLapsingEmailBackend(FailingEmailBackend):
+    """Fails slowly enough for the lease to lapse and another worker to claim the row."""
+
+    def send_messages(self, messages):
+        OutboundEmail.objects.update(next_attempt=timezone.now())
+        OutboundEmail.objects.claim_batch(10, lease_secs=60)
+        super(LeaseLapsingEmailBackend, self).send_messages(messages)
+
+
+class OutboxTest(TestCase):
+    def _enqueue(self, n=1):
+        for i in range(n):
+            enqueue_mail('subject {}'.format(i), 'text', 'support@brickly.local',
+                         ['user{}@example.com'.format(i)], html_message='<p>html</p>')
+
+    def test_worker_drains_outbox(self):
+        self._enqueue(5)
+        OutboxWorker(None, batch_size=2).drain()
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>html</p>', 'text/html')])
+        self.assertEqual(OutboundEmail.objects.queue_depth(), 0)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.STATUS_SENT).count(), 5)
+
+    def test_claimed_rows_are_not_claimed_twice(self):
+        self._enqueue(3)
+        first = OutboundEmail.objects.claim_batch(10, lease_secs=60)
+        second = OutboundEmail.objects.claim_batch(10, lease_secs=60)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(second, [])
+
+    @override_settings(EMAIL_BACKEND='myapp.tests.FailingEmailBackend')
+    def test_failed_send_is_retried_with_backoff(self):
+        self._enqueue()
+        OutboxWorker(None).drain()
+
+        outbound = OutboundEmail.objects.get()
+        self.assertEqual(outbound.status, OutboundEmail.STATUS_PENDING)
+        self.assertEqual(outbound.attempts, 1)
+        self.assertGreater(outbound.next_attempt, timezone.now() + datetime.timedelta(seconds=20))
+        self.assertEqual(OutboundEmail.objects.claim_batch(10, lease_secs=60), [])
+
+    @override_settings(EMAIL_BACKEND='myapp.tests.FailingEmailBackend',
+                       EMAIL_OUTBOX=dict(max_attempts=1, backoff_secs=0, batch_size=10,
+                                         poll_interval=0, lease_secs=60, workers=1))
+    def test_gives_up_after_max_attempts(self):
+        self._enqueue()
+        OutboxWorker(None).drain()
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.STATUS_FAILED)
+
+    @override_settings(EMAIL_BACKEND='myapp.tests.LeaseLapsingEmailBackend')
+    def test_outcome_after_a_lapsed_lease_is_dropped(self):
+        self._enqueue()
+        [first] = OutboundEmail.objects.claim_batch(10, lease_secs=0)
+        OutboxWorker(None).deliver([first])
+
+        # The late failure neither reschedules the row nor takes it from the second claim.
+        second = OutboundEmail.objects.get()
+        self.assertEqual((second.status, second.attempts), (OutboundEmail.STATUS_SENDING, 0))
+        self.assertNotEqual(second.claim, first.claim)
+        self.assertEqual(OutboundEmail.objects.mark_sent([first.id], first.claim), 0)
+        self.assertEqual(OutboundEmail.objects.mark_sent([second.id], second.claim), 1)
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.STATUS_SENT)
+
+
+class SetAsPrimaryTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+        self.emails = [Email.objects.create(user=self.user, address='ann{}@example.com'.format(i), is_verified=True)
+                       for i in range(3)]
+
+    def test_switch_moves_primary_and_user_email(self):
+        self.emails[0].set_as_primary()
+        self.emails[1].set_as_primary()
+
+        self.assertEqual(list(Email.objects.filter(user=self.user, is_primary=True)), [self.emails[1]])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, self.emails[1].address)
+
+    def test_switch_is_a_fixed_number_of_queries(self):
+        self.emails[0].set_as_primary()
+        with self.assertNumQueries(5):  # savepoint, user, demote, promote, release
+            self.emails[2].set_as_primary()
+
+    def test_constraint_rejects_second_primary(self):
+        self.emails[0].set_as_primary()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Email.objects.filter(pk=self.emails[1].pk).update(is_primary=True)
+
+
+class PrimaryEmailTest(TestCase):
+    def setUp(self):
+        user_model = get_user_model()
+        self.users = [user_model.objects.create(username='user{}'.format(i)) for i in range(4)]
+        self.primary = [Email.objects.create(user=user, address='{}@example.com'.format(user.username),
+                                             is_verified=True, is_primary=True) for user in self.users[:2]]
+        # Not verified yet; user3 has no emails at all.
+        self.unverified = Email.objects.create(user=self.users[2], address='user2@example.com', is_primary=True)
+
+    def test_get_primary(self):
+        self.assertEqual(Email.objects.get_primary(self.users[0]), self.primary[0])
+        self.assertIsNone(Email.objects.get_primary(self.users[2]))
+        self.assertEqual(Email.objects.get_primary(self.users[2].pk, verify_check=False), self.unverified)
+
+    def test_get_primary_for_users(self):
+        user_ids = [user.pk for user in self.users]
+        with self.assertNumQueries(2):
+            primary = Email.objects.get_primary_for_users(user_ids, chunk_size=2)
+        self.assertEqual(primary, {user_ids[0]: self.primary[0], user_ids[1]: self.primary[1],
+                                   user_ids[2]: None, user_ids[3]: None})
+
+
+@override_settings(PRIMARY_EMAIL_CACHE={'alias': 'default', 'timeout': 300})
+class PrimaryEmailCacheTest(TransactionTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user = get_user_model().objects.create(username='ann')
+        self.emails = [Email.objects.create(user=self.user, address='ann{}@example.com'.format(i), is_verified=True)
+                       for i in range(2)]
+        self.nobody = get_user_model().objects.create(username='bob')
+
+    def test_cached_until_set_as_primary(self):
+        user_ids = [self.user.pk, self.nobody.pk]
+        self.assertEqual(Email.objects.get_primary_for_users(user_ids), {self.user.pk: None, self.nobody.pk: None})
+        with self.assertNumQueries(0):
+            self.assertEqual(Email.objects.get_primary_for_users(user_ids), {self.user.pk: None, self.nobody.pk: None})
+
+        self.emails[0].set_as_primary()
+        self.assertEqual(Email.objects.get_primary(self.user), self.emails[0])
+        self.emails[1].set_as_primary()
+        self.assertEqual(Email.objects.get_primary(self.user), self.emails[1])
+        with self.assertNumQueries(0):
+            self.assertEqual(Email.objects.get_primary(self.user).address, 'ann1@example.com')
+
+    def test_invalidated_by_batch_relabel(self):
+        self.emails[0].set_as_primary()
+        self.assertIsNone(Email.objects.get_primary(self.user).label)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/myapp/batch/', {'operations': [
+            {'op': 'set_label', 'id': self.emails[0].pk, 'label': 'work'}]}, format='json')
+        self.assertEqual(response.status_code, StatusCode.SUCCESS)
+        self.assertEqual(Email.objects.get_primary(self.user).label, 'work')
+
+    def test_first_readers_share_a_version(self):
+        cache = primary_email_cache
+        # Another reader creates the version after this one's get_many found none.
+        self.assertTrue(cache.cache.add(cache._version_key(self.nobody.pk), 'theirs', None))
+        with mock.patch.object(cache.cache, 'get_many', return_value={}):
+            self.assertEqual(cache.versions([self.nobody.pk]), {self.nobody.pk: 'theirs'})
+
+    def test_invalidated_on_delete(self):
+        self.emails[0].set_as_primary()
+        self.assertEqual(Email.objects.get_primary(self.user), self.emails[0])
+        self.emails[0].delete()
+        self.assertIsNone(Email.objects.get_primary(self.user))
+
+
+class SetAsPrimaryConcurrencyTest(TransactionTestCase):
+    threads = 8
+    rounds = 10
+
+    def test_concurrent_switches_leave_one_primary(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("threads cannot share an in-memory SQLite test database")
+
+        user = get_user_model().objects.create(username='ann')
+        emails = [Email.objects.create(user=user, address='ann{}@example.com'.format(i), is_verified=True)
+                  for i in range(self.threads)]
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def switch(email):
+            try:
+                barrier.wait()
+                for _ in range(self.rounds):
+                    email.set_as_primary()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=switch, args=(email,)) for email in emails]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        primary = Email.objects.get(user=user, is_primary=True)
+        user.refresh_from_db()
+        self.assertEqual(user.email, primary.address)
+
+
+class DeleteExpiredConfirmationsTest(TestCase):
+    def test_deletes_only_expired_rows_in_chunks(self):
+        user = get_user_model().objects.create(username='ann')
+        email = Email.objects.create(user=user, address='ann@example.com')
+        now = timezone.now()
+        for i in range(5):
+            EmailConfirmation.objects.create(email=email, token_hash='old{}'.format(i),
+                                             sent=now - datetime.timedelta(hours=2))
+        fresh = EmailConfirmation.objects.create(email=email, token_hash='fresh', sent=now)
+
+        with self.assertNumQueries(6):  # select ids + delete, for each of 3 chunks
+            deleted = EmailConfirmation.objects.delete_expired_confirmations(3600, chunk_size=2)
+
+        self.assertEqual(deleted, 5)
+        self.assertEqual(list(EmailConfirmation.objects.all()), [fresh])
+
+
+class EmailConfirmationCheckTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+        self.email = Email.objects.create(user=self.user, address='ann@example.com')
+        self.confirmation = self.email.create_confirmation(4)
+
+    def test_only_the_hash_is_stored(self):
+        self.assertEqual(len(self.confirmation.token), 4)
+        self.assertEqual(EmailConfirmation.objects.get().token_hash,
+                         hash_confirmation_token(self.user.pk, self.confirmation.token))
+
+    def test_get_checked(self):
+        with self.assertNumQueries(1):
+            record = EmailConfirmation.get_checked(self.user, self.confirmation.token, 60)
+            self.assertEqual(record.email, self.email)
+
+        other = get_user_model().objects.create(username='bob')
+        self.assertIsNone(EmailConfirmation.get_checked(other, self.confirmation.token, 60))
+
+        EmailConfirmation.objects.update(sent=timezone.now() - datetime.timedelta(seconds=61))
+        self.assertIsNone(EmailConfirmation.get_checked(self.user, self.confirmation.token, 60))
+
+
+class GetUsersForManyTest(TestCase):
+    def setUp(self):
+        user_model = get_user_model()
+        self.ann = user_model.objects.create(username='ann')
+        self.bob = user_model.objects.create(username='bob')
+        Email.objects.create(user=self.ann, address='ann@example.com', address_normalized='ann@example.com',
+                             is_verified=True)
+        Email.objects.create(user=self.ann, address='Ann@Work.com', address_normalized='ann@work.com',
+                             is_verified=True)
+        Email.objects.create(user=self.bob, address='bob@example.com', address_normalized='bob@example.com')
+
+    def test_mapping(self):
+        addresses = ['ANN@example.com', ' ann@work.com', 'bob@example.com', 'nobody@example.com', 'ann@example.com']
+        with self.assertNumQueries(2):
+            users = Email.objects.get_users_for_many(addresses, chunk_size=2)
+        self.assertEqual(list(users), addresses)
+        self.assertEqual(users['ANN@example.com'], [self.ann])
+        self.assertIs(users['ANN@example.com'][0], users[' ann@work.com'][0])
+        self.assertEqual(users['bob@example.com'], [])  # not verified
+        self.assertEqual(users['nobody@example.com'], [])
+
+    def test_memo(self):
+        memo = {}
+        Email.objects.get_users_for_many(['ann@example.com', 'nobody@example.com'], memo=memo)
+        with self.assertNumQueries(0):
+            users = Email.objects.get_users_for_many(['Ann@Example.com', 'nobody@example.com'], memo=memo)
+        self.assertEqual(users, {'Ann@Example.com': [self.ann], 'nobody@example.com': []})
+        with self.assertNumQueries(1):
+            Email.objects.get_users_for_many(['ann@work.com', 'ann@example.com'], memo=memo)
+
+        users['Ann@Example.com'].clear()
+        self.assertEqual(Email.objects.get_users_for_many(['ann@example.com'], memo=memo),
+                         {'ann@example.com': [self.ann]})
+
+    def test_failed_chunk_is_not_memoized(self):
+        manager = get_user_model().objects
+        lookup = manager.filter
+        lookups = []
+
+        def fail_second_chunk(*args, **kwargs):
+            lookups.append(kwargs)
+            if len(lookups) == 2:
+                raise DatabaseError('connection lost')
+            return lookup(*args, **kwargs)
+
+        memo = {}
+        with mock.patch.object(manager, 'filter', side_effect=fail_second_chunk), \
+                self.assertRaises(DatabaseError):
+            Email.objects.get_users_for_many(['ann@example.com', 'ann@work.com'], chunk_size=1, memo=memo)
+        self.assertEqual(memo, {address: [self.ann] for address in memo})
+        self.assertEqual(len(memo), 1)
+
+
+class EmailAddTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_address_in_use_by_any_account_conflicts(self):
+        other = get_user_model().objects.create(username='bob')
+        Email.objects.create(user=other, address='Bob@Example.com')
+        self.assertEqual(Email.objects.get().address_normalized, 'bob@example.com')
+
+        response = self.client.post('/myapp/add/', {'email': 'bob@example.com'})
+        self.assertEqual(response.status_code, StatusCode.ERROR_CONFLICT)
+
+        response = self.client.post('/myapp/add/', {'email': 'ann@example.com'})
+        self.assertEqual(response.status_code, StatusCode.SUCCESS)
+        self.assertTrue(Email.objects.filter(user=self.user, address_normalized='ann@example.com').exists())
+
+
+class EmailListCacheTest(TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+        self.email = Email.objects.create(user=self.user, address='ann@example.com', is_verified=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        email_list_cache.cache.clear()
+
+    def addresses(self):
+        return [row['address'] for row in self.client.get('/myapp/get/').json()['result']]
+
+    def test_list_is_cached_until_emails_change(self):
+        self.assertEqual(self.addresses(), ['ann@example.com'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.addresses(), ['ann@example.com'])
+
+        Email.objects.create(user=self.user, address='ann2@example.com')
+        self.assertEqual(self.addresses(), ['ann@example.com', 'ann2@example.com'])
+
+        self.email.delete()
+        self.assertEqual(self.addresses(), ['ann2@example.com'])
+
+    def test_set_as_primary_invalidates(self):
+        self.addresses()
+        self.email.set_as_primary()
+        self.assertTrue(self.client.get('/myapp/get/').json()['result'][0]['is_primary'])
+
+    def test_concurrent_misses_fill_once(self):
+        cache = EmailListCache(alias='missing-alias')
+        fills = []
+
+        def fill():
+            fills.append(1)
+            # Hold the fill until every thread has missed and queued on the flight, so none
+            # of them can arrive late and see a plain hit.
+            deadline = time.monotonic() + 5
+            while sum(waiters for _lock, waiters in cache._flights.values()) < 5 and time.monotonic() < deadline:
+                time.sleep(0.001)
+            return ['value']
+
+        threads = [threading.Thread(target=cache.get, args=(self.user.pk, fill)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(fills), 1)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 1, 'coalesced': 4})
+
+    def test_conditional_get(self):
+        response = self.client.get('/myapp/get/')
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/myapp/get/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, StatusCode.WARNING_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        Email.objects.create(user=self.user, address='ann2@example.com')
+        response = self.client.get('/myapp/get/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, StatusCode.SUCCESS)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_deploy_check_wants_a_shared_cache(self):
+        self.assertEqual([warning.id for warning in check_email_list_cache(None)], ['myapp.W001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+            self.assertEqual(check_email_list_cache(None), [])
+
+
+@override_settings(TEMPLATES=[{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        'subject.txt': 'Hello\n{{ name }}',
+        'body.txt': 'Code: {{ code }}',
+        'body.html': '<p>{{ name }}: {{ code }}</p>',
+        'de/subject.txt': 'Hallo {{ name }}',
+    })]},
+}])
+class EmailRendererTest(SimpleTestCase):
+    def setUp(self):
+        self.renderer = EmailRenderer('subject.txt', 'body.txt', 'body.html', maxsize=2)
+
+    def test_render(self):
+        subject, text, html = self.renderer.render({'name': 'Ann <ann>', 'code': '0042'}, 'en-us')
+        self.assertEqual(subject, 'HelloAnn &lt;ann&gt;')  # newlines dropped from the subject
+        self.assertEqual(text, 'Code: 0042')
+        self.assertEqual(html, '<p>Ann &lt;ann&gt;: 0042</p>')
+
+    def test_language_specific_templates_win(self):
+        subject, text, _html = self.renderer.render({'name': 'Ann', 'code': '0042'}, 'de')
+        self.assertEqual(subject, 'Hallo Ann')
+        self.assertEqual(text, 'Code: 0042')  # no German body: the shared one is used
+
+    def test_templates_are_cached_per_language(self):
+        english = self.renderer.templates('en-us')
+        self.assertIs(self.renderer.templates('en-us'), english)
+        self.assertIsNot(self.renderer.templates('de'), english)
+
+        self.renderer.templates('fr')  # evicts the least recently used, en-us
+        self.assertEqual(list(self.renderer._cache), ['de', 'fr'])
+        self.assertIsNot(self.renderer.templates('en-us'), english)
+
+    def test_clear(self):
+        english = self.renderer.templates('en-us')
+        self.renderer.clear()
+        self.assertEqual(len(self.renderer._cache), 0)
+        self.assertIsNot(self.renderer.templates('en-us'), english)
+
+    @override_settings(TEMPLATES=settings.TEMPLATES)
+    def test_confirmation_email(self):
+        renderer = EmailRenderer('emails/confirm_subject.txt', 'emails/confirm.txt', 'emails/confirm.html')
+        subject, text, html = renderer.render({'first_name': 'Ann', 'token': '0042', 'browser_name': '',
+                                               'support_url': 'https://support', 'website_url': 'https://site'},
+                                              'en-us')
+        self.assertEqual(subject, 'Confirm your email address')
+        self.assertIn('Hi Ann,', text)
+        self.assertIn('confirm your email address: 0042', text)
+        self.assertNotIn('This request was made from', text)
+        self.assertIn('<strong>0042</strong>', html)
+
+
+class EnvelopeEncoderTest(TestCase):
+    def test_output_matches_json_dumps(self):
+        encoder = EnvelopeEncoder(StdlibJSONBackend())
+        results = [None, {}, 0, 'ü', {'a': [1, 2.5, None]}, [], [{'id': i, 'label': 'é'} for i in range(600)],
+                   {'when': timezone.now(), 'uuid': uuid.uuid4()}]
+        for result in results:
+            expected = json.dumps({'status': 'success', 'message': 'Success', 'result': result}, cls=JSONEncoder)
+            self.assertEqual(encoder.encode('success', 'Success', result), expected)
+            if isinstance(result, list):
+                self.assertEqual(''.join(encoder.iter_encode('success', 'Success', result)), expected)
+
+    @override_settings(REST_VIEW={'json_backend': 'stdlib', 'stream_threshold': 2})
+    def test_large_lists_are_streamed(self):
+        user = get_user_model().objects.create(username='ann')
+        for i in range(3):
+            Email.objects.create(user=user, address='ann{}@example.com'.format(i))
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.get('/myapp/get/')
+        self.assertTrue(response.streaming)
+        body = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(body['result']), 3)
+
+
+class EmailListPaginationTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+        self.emails = [Email.objects.create(user=self.user, address='ann{}@example.com'.format(i)) for i in range(5)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_keyset_pages(self):
+        seen, cursor = [], None
+        while True:
+            params = {'page_size': 2}
+            if cursor:
+                params['cursor'] = cursor
+            result = self.client.get('/myapp/get/', params).json()['result']
+            seen.extend(row['id'] for row in result['results'])
+            cursor = result['next']
+            if not cursor:
+                break
+        self.assertEqual(seen, [email.id for email in self.emails])
+
+    def test_sparse_fields(self):
+        with self.assertNumQueries(1):
+            result = self.client.get('/myapp/get/', {'fields': 'address,label'}).json()['result']
+        self.assertEqual(result['results'][0], {'address': 'ann0@example.com', 'label': None})
+
+    def test_invalid_parameters(self):
+        for params in ({'fields': 'address,password'}, {'cursor': '!!'}, {'page_size': 0}):
+            response = self.client.get('/myapp/get/', params)
+            self.assertEqual(response.status_code, StatusCode.ERROR, params)
+
+
+class EmailReadSerializerTest(TestCase):
+    def test_matches_model_serializer(self):
+        user = get_user_model().objects.create(username='ann')
+        Email.objects.create(user=user, address='ann@example.com', is_verified=True, label='home')
+        Email.objects.create(user=user, address='ann2@example.com')
+        queryset = Email.objects.filter(user=user).order_by('id')
+
+        expected = EmailSerializer(queryset, many=True).data
+        self.assertEqual(EmailReadSerializer(queryset, many=True).data, expected)
+        self.assertEqual(EmailReadSerializer(list(queryset), many=True).data, expected)
+        self.assertEqual(EmailReadSerializer(queryset[0]).data, expected[0])
+
+
+class EmailBatchTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+        self.primary = Email.objects.create(user=self.user, address='ann@example.com', is_primary=True)
+        self.other = Email.objects.create(user=self.user, address='ann2@example.com')
+        self.labelled = Email.objects.create(user=self.user, address='ann3@example.com')
+        Email.objects.create(user=get_user_model().objects.create(username='bob'), address='bob@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_batch(self):
+        operations = [
+            {'op': 'add', 'email': 'new@Example.com'},
+            {'op': 'add', 'email': 'BOB@example.com'},
+            {'op': 'add', 'email': 'not an email'},
+            {'op': 'remove', 'id': self.other.pk},
+            {'op': 'remove', 'id': self.primary.pk},
+            {'op': 'set_label', 'id': self.labelled.pk, 'label': 'work'},
+            {'op': 'set_label', 'id': 999999, 'label': 'x'},
+            {'op': 'rename'},
+        ]
+        response = self.client.post('/myapp/batch/', {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, StatusCode.SUCCESS)
+        statuses = [item['status'] for item in response.json()['result']]
+        self.assertEqual(statuses, ['success_created', 'error_conflict', 'error', 'success', 'error_not_allowed',
+                                    'success', 'error_not_found', 'error'])
+        self.assertEqual(response.json()['result'][0]['object']['address'], 'new@example.com')
+
+        self.assertEqual(sorted(Email.objects.filter(user=self.user).values_list('address', flat=True)),
+                         ['ann3@example.com', 'ann@example.com', 'new@example.com'])
+        self.labelled.refresh_from_db()
+        self.assertEqual(self.labelled.label, 'work')
+
+    def post_after_validate(self, operations, meanwhile):
+        """Post ``operations``, running ``meanwhile`` between validation and the transaction."""
+        validate = EmailBatch._validate
+
+        def validate_then_race(view, *args):
+            validated = validate(view, *args)
+            meanwhile()
+            return validated
+
+        with mock.patch.object(EmailBatch, '_validate', autospec=True, side_effect=validate_then_race):
+            response = self.client.post('/myapp/batch/', {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, StatusCode.SUCCESS)
+        return [item['status'] for item in response.json()['result']]
+
+    def test_email_made_primary_meanwhile_is_not_removed(self):
+        def switch():
+            Email.objects.filter(pk=self.primary.pk).update(is_primary=False)
+            Email.objects.filter(pk=self.other.pk).update(is_primary=True)
+
+        statuses = self.post_after_validate([{'op': 'remove', 'id': self.other.pk}], switch)
+        self.assertEqual(statuses, ['error_not_allowed'])
+        self.assertTrue(Email.objects.filter(pk=self.other.pk).exists())
+
+    def test_address_taken_meanwhile_fails_only_its_add(self):
+        def take():
+            Email.objects.create(user=get_user_model().objects.get(username='bob'), address='NEW@example.com')
+
+        statuses = self.post_after_validate([
+            {'op': 'add', 'email': 'new@example.com'},
+            {'op': 'add', 'email': 'newer@example.com'},
+            {'op': 'set_label', 'id': self.labelled.pk, 'label': 'work'},
+        ], take)
+        self.assertEqual(statuses, ['error_conflict', 'success_created', 'success'])
+        self.assertTrue(Email.objects.filter(user=self.user, address='newer@example.com').exists())
+
+
+class ParamSchemaTest(TestCase):
+    class SchemaView(RestView):
+        permission_classes = ()
+        param_schema = {
+            'id': IntParam(),
+            'email': EmailParam(),
+            'verbose': BoolParam(required=False, default=False),
+            'label': StringParam(required=False),
+        }
+
+        def _post(self):
+            return self.success(self.params)
+
+    def post(self, data):
+        request = APIRequestFactory().post('/schema/?verbose=yes', data, format='json')
+        return json.loads(self.SchemaView.as_view()(request).content)
+
+    def test_converted_values(self):
+        body = self.post({'id': '7', 'email': 'Ann@Example.COM'})
+        self.assertEqual(body['result'], {'id': 7, 'email': 'Ann@example.com', 'verbose': True, 'label': None})
+
+    def test_all_invalid_fields_are_reported(self):
+        body = self.post({'id': 'x', 'label': 3})
+        self.assertEqual(body['status'], 'error')
+        self.assertEqual(body['result'], {'errors': {
+            'id': 'Please enter a valid integer',
+            'email': 'Please enter a valid email',
+            'label': 'Please enter a valid string',
+        }})
+
+
+class DatetimeTest(SimpleTestCase):
+    def test_supported_formats(self):
+        expected = datetime.datetime(2018, 6, 22, 4, 58, 1)
+        for var in ('2018-06-22T04:58:01', '2018-06-22T04:58:01Z', '2018-06-22 04:58:01', '2018-6-22 4:58:1'):
+            self.assertEqual(Datetime.strptime(var), expected, var)
+        self.assertEqual(Datetime.strptime('2018-06-22T04:58:01.5'), expected.replace(microsecond=500000))
+        self.assertEqual(Datetime.strptime('2018-06-22', '%Y-%m-%d'), datetime.datetime(2018, 6, 22))
+        self.assertIsNone(Datetime.strptime(''))
+
+    def test_error_messages_are_unchanged(self):
+        with self.assertRaisesMessage(ValueError, "time data '2018-06-22' does not match formats ['%Y-%m-%dT%H:%M:%S'"):
+            Datetime.strptime('2018-06-22')
+        with self.assertRaisesMessage(ValueError, "time data '2018-02-30' does not match formats ['%Y-%m-%d']"):
+            Datetime.strptime('2018-02-30', '%Y-%m-%d')
+
+    def test_parse_many(self):
+        self.assertEqual(Datetime.parse_many(['2018-06-22', 'x'], '%Y-%m-%d', errors='ignore'),
+                         [datetime.datetime(2018, 6, 22), None])
+        with self.assertRaises(ValueError):
+            Datetime.parse_many(['2018-06-22', 'x'], '%Y-%m-%d')
+
+
+class TokenBucketThrottleTest(TestCase):
+    class ThrottledView(RestView):
+        token_buckets = {'user': '3/min', 'address': '1/min'}
+
+        def _get(self):
+            return self.success({})
+
+    def setUp(self):
+        token_bucket.cache.clear()
+        self.user = get_user_model().objects.create(username='ann')
+
+    def get(self, **params):
+        request = APIRequestFactory().get('/throttled/', params)
+        force_authenticate(request, self.user)
+        return self.ThrottledView.as_view()(request)
+
+    def test_user_and_address_buckets(self):
+        self.assertEqual(self.get(email='a@example.com').status_code, StatusCode.SUCCESS)
+        response = self.get(email='A@example.com')
+        self.assertEqual(response.status_code, StatusCode.ERROR_TOO_MANY_REQUESTS)
+        self.assertEqual(json.loads(response.content)['status'], 'error_too_many_requests')
+        self.assertEqual(response['Retry-After'], '60')
+
+        # The rejected request took no token from the user bucket: two are left for other addresses.
+        self.assertEqual(self.get(email='b@example.com').status_code, StatusCode.SUCCESS)
+        self.assertEqual(self.get(email='c@example.com').status_code, StatusCode.SUCCESS)
+        self.assertEqual(self.get(email='d@example.com').status_code, StatusCode.ERROR_TOO_MANY_REQUESTS)
+
+    def test_consume_all_is_all_or_nothing(self):
+        bucket = TokenBucket(alias='missing-alias')
+        self.assertEqual(bucket.consume_all([('a', 2, 10), ('b', 1, 10)], now=100), (True, [0, 0]))
+        self.assertEqual(bucket.consume_all([('a', 2, 10), ('b', 1, 10)], now=100), (False, [0, 10.0]))
+        self.assertEqual(bucket.consume('a', 2, 10, now=100), (True, 0))  # the rejection left a's token
+
+    def test_bucket_refills(self):
+        bucket = TokenBucket(alias='missing-alias')
+        self.assertEqual(bucket.consume('k', 1, 10, now=100), (True, 0))
+        self.assertEqual(bucket.consume('k', 1, 10, now=105), (False, 5.0))
+        self.assertEqual(bucket.consume('k', 1, 10, now=110), (True, 0))
+
+
+class AsyncRestViewTest(TestCase):
+    class AsyncView(AsyncRestView):
+        param_schema = {'id': IntParam()}
+
+        async def _get(self):
+            count = await sync_to_async(Email.objects.filter(user=self._user).count)()
+            return self.success({'id': self.params['id'], 'emails': count})
+
+        async def _delete(self):
+            raise InvalidArgumentError("Nothing to delete")
+
+        def _post(self):
+            return self.success(Email.objects.filter(user=self._user).count(), status_code=StatusCode.SUCCESS_CREATED)
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+        Email.objects.create(user=self.user, address='ann@example.com')
+
+    def call(self, method, **params):
+        request = getattr(APIRequestFactory(), method)('/async/', params, format='json')
+        force_authenticate(request, self.user)
+        return async_to_sync(self.AsyncView.as_view())(request)
+
+    def test_handlers_keep_the_envelope(self):
+        self.assertTrue(asyncio.iscoroutinefunction(self.AsyncView.as_view()))
+        self.assertEqual(json.loads(self.call('get', id='7').content),
+                         {'status': 'success', 'message': 'Success', 'result': {'id': 7, 'emails': 1}})
+        response = self.call('post', id=1)
+        self.assertEqual(response.status_code, StatusCode.SUCCESS_CREATED)
+        self.assertEqual(json.loads(response.content)['result'], 1)
+
+    def test_errors(self):
+        body = json.loads(self.call('get', id='x').content)
+        self.assertEqual(body['result'], {'errors': {'id': 'Please enter a valid integer'}})
+        self.assertEqual(json.loads(self.call('delete', id=1).content)['message'], 'Nothing to delete')
+        self.assertEqual(self.call('patch', id=1).status_code, StatusCode.ERROR_NOT_SUPPORTED)
+
+        request = APIRequestFactory().get('/async/', {'id': 1})
+        response = async_to_sync(self.AsyncView.as_view())(request)
+        self.assertEqual(response.status_code, StatusCode.ERROR_UNAUTHORIZED)
+
+    def test_served_through_wsgi(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get('/myapp/send_confirmation/', {'email': 'bob@example.com'})
+        self.assertEqual(response.status_code, StatusCode.ERROR_NOT_FOUND)
+        self.assertEqual(response.json()['message'], 'Email not associated with any account.')
+
+
+@unittest.skipUnless('replica' in settings.DATABASES, "no 'replica' database configured")
+@override_settings(READ_REPLICAS={'databases': ['replica'], 'sticky_secs': 60, 'cache': 'default'})
+class ReplicaRouterTest(TransactionTestCase):
+    """Needs a 'replica' alias, such as brickly.settings_benchmark's mirror of the test database."""
+    # The runner sets up every alias named here, even for skipped classes.
+    databases = {'default', 'replica'} if 'replica' in settings.DATABASES else {'default'}
+
+    def setUp(self):
+        caches['default'].clear()
+        email_list_cache.cache.clear()
+        self.user = get_user_model().objects.create(username='ann')
+        Email.objects.create(user=self.user, address='ann@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def queries(self, method, path, data=None):
+        """``(primary, replica)`` query counts of one successful request."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(path, data)
+        self.assertEqual(response.status_code, StatusCode.SUCCESS, response.content)
+        return len(primary), len(replica)
+
+    def test_routing(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Email), 'default')
+        with use_replicas():
+            self.assertEqual(router.db_for_read(Email), 'replica')
+            self.assertEqual(router.db_for_write(Email), 'default')
+
+    def test_reads_go_to_replica_until_the_user_writes(self):
+        self.assertEqual(self.queries('get', '/myapp/get/', {'page_size': 10}), (0, 1))
+        self.queries('post', '/myapp/add/', {'email': 'ann2@example.com'})
+        self.assertEqual(self.queries('get', '/myapp/get/', {'page_size': 10}), (1, 0))
+
+    def test_cache_fills_read_the_primary(self):
+        # A lagging replica's rows would be cached under the current version and served until they expire.
+        self.assertEqual(self.queries('get', '/myapp/get/'), (1, 0))
+        self.assertEqual(self.queries('get', '/myapp/get/'), (0, 0))
+
+
+class RequestMetricsTest(TestCase):
+    def setUp(self):
+        request_metrics.clear()
+        email_list_cache.cache.clear()
+        self.user = get_user_model().objects.create(username='ann')
+        Email.objects.create(user=self.user, address='ann@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def scrape(self):
+        response = self.client.get('/myapp/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_requests_are_recorded_per_view_and_status(self):
+        body = self.client.get('/myapp/get/').content
+        self.client.get('/myapp/get/')
+        self.client.post('/myapp/add/', {'email': 'ann@example.com'})
+        self.client.get('/myapp/send_confirmation/', {'email': 'bob@example.com'})
+
+        text = self.scrape()
+        self.assertIn('myapp_request_duration_seconds_count{view="EmailList",status="success"} 2', text)
+        self.assertIn('myapp_request_duration_seconds_count{view="EmailAdd",status="error_conflict"} 1', text)
+        self.assertIn('myapp_request_queries_count{view="EmailSendConfirmation",status="error_not_found"} 1', text)
+        # Only the first list request misses the cache and queries; the second is served from it.
+        self.assertIn('myapp_request_queries_sum{view="EmailList",status="success"} 1.0', text)
+        self.assertIn('myapp_response_bytes_sum{{view="EmailList",status="success"}} {!r}'.format(2.0 * len(body)), text)
+        self.assertIn('myapp_request_queries_bucket{view="EmailList",status="success",le="0.0"} 1', text)
+        self.assertIn('myapp_request_queries_bucket{view="EmailList",status="success",le="+Inf"} 2', text)
+
+    @override_settings(METRICS={'enabled': False, 'allowed_ips': ['127.0.0.1']})
+    def test_disabled(self):
+        self.client.get('/myapp/get/')
+        self.assertNotIn('EmailList', self.scrape())
+
+    def test_scrape_is_local_only(self):
+        self.assertEqual(self.client.get('/myapp/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ann')
+
+    def test_exceeding_a_budget_fails(self):
+        @query_budget(1)
+        def two_queries():
+            Email.objects.count()
+            Email.objects.exists()
+
+        with self.assertRaisesRegex(QueryBudgetExceeded, r'two_queries made 2 queries, over its budget of 1'):
+            two_queries()
+        with QueryBudget('atomic', 1):
+            with transaction.atomic():  # savepoints are not counted
+                Email.objects.count()
+
+    @override_settings(DEBUG=True, QUERY_BUDGETS={'raise': False})
+    def test_debug_mode_logs_the_sql(self):
+        with self.assertLogs('myapp.budgets', 'WARNING') as logs:
+            with QueryBudget('block', 0):
+                Email.objects.filter(address='ann@example.com').count()
+        self.assertIn('block made 1 queries, over its budget of 0', logs.output[0])
+        self.assertIn('ann@example.com', logs.output[0])
+
+    def test_view_budget(self):
+        class View(RestView):
+            query_budget = 1
+
+            def _get(self):
+                Email.objects.count()
+                Email.objects.count()
+                return self.success({})
+
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, self.user)
+        with self.assertRaises(QueryBudgetExceeded):
+            View.as_view()(request)
+
+    def test_add_email_queues_a_confirmation(self):
+        email = Email.objects.add_email(self.user, 'ann@example.com', confirm=True)
+        outbound = OutboundEmail.objects.get()
+        self.assertEqual(outbound.recipient_list, ['ann@example.com'])
+        self.assertIn(email.confirmation.token, outbound.body)
+        self.assertEqual(EmailConfirmation.get_checked(self.user, email.confirmation.token, 60).email, email)
+
+        Email.objects.add_email(self.user, 'ann2@example.com', is_verified=True, confirm=True)
+        self.assertEqual(OutboundEmail.objects.count(), 1)
+
+    def test_manager_budgets(self):
+        Email.objects.create(user=self.user, address='ann@example.com', is_verified=True)
+        Email.objects.create(user=get_user_model().objects.create(username='bob'), address='bob@example.com',
+                             is_verified=True)
+        self.assertEqual([user.username for user in Email.objects.get_users_for('ANN@example.com')], ['ann'])
+        OutboundEmail.objects.enqueue('subject', 'text', 'support@brickly.local', ['ann@example.com'])
+        batch = OutboundEmail.objects.claim_batch(10, 60)
+        OutboundEmail.objects.mark_sent([outbound.id for outbound in batch], batch[0].claim)
+        self.assertEqual(OutboundEmail.objects.queue_depth(), 0)
+
+
+class SignedTokenTest(TestCase):
+    def setUp(self):
+        verified_users.clear()
+        self.user = get_user_model().objects.create(username='ann')
+        self.client = APIClient()
+
+    def test_check_token(self):
+        token = make_token(self.user, 'email_confirm', now=1000)
+        self.assertEqual(token['expires'], 1000 + settings.API_TOKENS['max_age']['email_confirm'])
+        self.assertEqual(check_token(token['token'], ('email_confirm',), now=1001),
+                         ('email_confirm', self.user.pk, user_fingerprint(self.user)))
+        for token, purposes, now in ((token['token'], ('api',), 1001),
+                                     (token['token'], ('email_confirm',), token['expires']),
+                                     (token['token'].replace('email_confirm', 'api'), ('api',), 1001),
+                                     ('garbage', ('api',), 1001)):
+            with self.assertRaises(InvalidToken):
+                check_token(token, purposes, now=now)
+
+    def test_bearer_authentication(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + make_token(self.user)['token'])
+        self.assertEqual(self.client.get('/myapp/get/').status_code, StatusCode.SUCCESS)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + make_token(self.user, 'email_confirm')['token'])
+        response = self.client.get('/myapp/get/')
+        self.assertEqual(response.status_code, StatusCode.ERROR_UNAUTHORIZED)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        response = self.client.get('/myapp/confirm_primary/', {'token': '0000'})
+        self.assertEqual(response.status_code, StatusCode.ERROR_FORBIDDEN)  # authenticated, wrong code
+        response = self.client.get('/myapp/send_confirmation/', {'email': 'ann@example.com'})
+        self.assertEqual(response.status_code, StatusCode.ERROR_UNAUTHORIZED)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + make_token(self.user)['token'])
+        self.assertEqual(self.client.post('/myapp/token/').status_code, StatusCode.ERROR_UNAUTHORIZED)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/myapp/confirm_primary/', {'token': '0000'}).status_code,
+                         StatusCode.ERROR_UNAUTHORIZED)
+
+    def test_password_change_revokes_tokens(self):
+        token = make_token(self.user)['token']
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        self.assertEqual(self.client.get('/myapp/get/').status_code, StatusCode.SUCCESS)
+
+        self.user.set_password('secret')
+        self.user.save()
+        self.assertEqual(self.client.get('/myapp/get/').status_code, StatusCode.ERROR_UNAUTHORIZED)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + make_token(self.user)['token'])
+        self.assertEqual(self.client.get('/myapp/get/').status_code, StatusCode.SUCCESS)
+
+        self.user.set_unusable_password()
+        self.user.save()
+        self.assertEqual(self.client.get('/myapp/get/').status_code, StatusCode.ERROR_UNAUTHORIZED)
+
+    def test_stale_cache_reloads_on_new_fingerprint(self):
+        fingerprint = user_fingerprint(self.user)
+        verified_users.load(self.user.pk, fingerprint)
+        self.user.set_password('secret')
+        get_user_model().objects.filter(pk=self.user.pk).update(password=self.user.password)  # no signal
+
+        with self.assertNumQueries(1):
+            self.assertEqual(verified_users.load(self.user.pk, user_fingerprint(self.user)), self.user)
+        with self.assertNumQueries(1), self.assertRaises(InvalidToken):
+            verified_users.load(self.user.pk, fingerprint)
+
+    def test_verified_users_are_cached(self):
+        class View(RestView):
+            def _get(self):
+                return self.success(self._user.username)
+
+        token = make_token(self.user)['token']
+
+        def get():
+            request = APIRequestFactory().get('/', HTTP_AUTHORIZATION='Bearer ' + token)
+            return View.as_view()(request)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(get().status_code, StatusCode.SUCCESS)
+        with self.assertNumQueries(0):
+            self.assertEqual(get().status_code, StatusCode.SUCCESS)
+        self.user.save()
+        with self.assertNumQueries(1):
+            get()
+
+
+class EndpointQueryBudgetTest(TestCase):
+    """Every endpoint in myapp.urls within its view's query budget (enforced by myapp.testing.TestRunner)."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = get_user_model().objects.create(username='ann', first_name='Ann')
+        self.primary = Email.objects.create(user=self.user, address='ann@example.com', is_verified=True,
+                                            is_primary=True)
+        self.verified = Email.objects.create(user=self.user, address='ann.work@example.com', is_verified=True)
+        self.unverified = Email.objects.create(user=self.user, address='ann.home@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertStatus(self, response, status_code):
+        self.assertEqual(response.status_code, status_code, response.content)
+
+    def test_get(self):
+        self.assertStatus(self.client.get('/myapp/get/'), StatusCode.SUCCESS)
+        self.assertStatus(self.client.get('/myapp/get/', {'page_size': 2}), StatusCode.SUCCESS)
+
+    def test_remove(self):
+        self.unverified.create_confirmation(4)
+        self.assertStatus(self.client.delete('/myapp/remove/', {'id': self.unverified.id}), StatusCode.SUCCESS)
+
+    def test_add(self):
+        self.assertStatus(self.client.post('/myapp/add/', {'email': 'ann2@example.com'}), StatusCode.SUCCESS)
+
+    def test_send_confirmation(self):
+        response = self.client.get('/myapp/send_confirmation/', {'email': self.unverified.address})
+        self.assertStatus(response, StatusCode.SUCCESS_CONFIRM)
+        self.assertEqual(check_token(response.json()['result']['token'], ('email_confirm',))[:2],
+                         ('email_confirm', self.user.pk))
+
+    def test_token(self):
+        self.assertStatus(self.client.post('/myapp/token/'), StatusCode.SUCCESS)
+
+    def test_send_confirmation_errors(self):
+        self.assertStatus(self.client.get('/myapp/send_confirmation/', {'email': self.verified.address}),
+                          StatusCode.ERROR_NOT_ALLOWED)
+        self.assertStatus(self.client.get('/myapp/send_confirmation/', {'email': 'bob@example.com'}),
+                          StatusCode.ERROR_NOT_FOUND)
+
+    def test_confirm_primary(self):
+        confirmation = self.unverified.create_confirmation(4)
+        self.assertStatus(self.client.get('/myapp/confirm_primary/', {'token': confirmation.token}),
+                          StatusCode.SUCCESS)
+        self.assertTrue(Email.objects.get(pk=self.unverified.pk).is_primary)
+
+    def test_set_primary(self):
+        response = self.client.post('/myapp/set_primary/', {'id': self.verified.id})
+        self.assertStatus(response, StatusCode.SUCCESS)
+        self.assertTrue(response.json()['result']['is_primary'])
+
+    def test_batch(self):
+        response = self.client.post('/myapp/batch/', {'operations': [
+            {'op': 'add', 'email': 'ann2@example.com'},
+            {'op': 'set_label', 'id': self.verified.id, 'label': 'work'},
+            {'op': 'remove', 'id': self.unverified.id},
+        ]}, format='json')
+        self.assertStatus(response, StatusCode.SUCCESS)
+
+    def test_index_and_metrics(self):
+        with self.assertNumQueries(0):
+            self.assertStatus(self.client.get('/myapp/index/'), 200)
+            self.assertStatus(self.client.get('/myapp/metrics/'), 200)
+
+
+class BenchmarkCompareTest(SimpleTestCase):
+    def test_regressions_beyond_threshold(self):
+        baseline = {'endpoints': [{'name': 'list', 'per_op_us': 100.0, 'p95_ms': 1.0},
+                                  {'name': 'add', 'per_op_us': 100.0, 'p95_ms': 1.0}]}
+        current = {'endpoints': [{'name': 'list', 'per_op_us': 109.0, 'p95_ms': 1.5},
+                                 {'name': 'add', 'per_op_us': 80.0, 'p95_ms': 1.0},
+                                 {'name': 'new', 'per_op_us': 1000.0}],
+                   'other': [{'name': 'list', 'per_op_us': 1000.0}]}
+        self.assertEqual(compare(baseline, current, 0.1), [('endpoints', 'list', 'p95_ms', 1.0, 1.5)])
+
+    def test_failures_are_regressions(self):
+        baseline = {'endpoints': [{'name': 'list', 'per_op_us': 100.0, 'p95_ms': 1.0},
+                                  {'name': 'add', 'per_op_us': 100.0, 'p95_ms': 1.0},
+                                  {'name': 'remove', 'per_op_us': 100.0}]}
+        current = {'endpoints': [{'name': 'list', 'error': 'AttributeError: boom'},
+                                 {'name': 'add', 'per_op_us': float('nan'), 'p95_ms': 1.0},
+                                 {'name': 'new', 'error': 'KeyError: x'}]}
+        self.assertEqual(compare(baseline, current, 0.1), [
+            ('endpoints', 'remove', 'missing', None, None),
+            ('endpoints', 'list', 'error', None, 'AttributeError: boom'),
+            ('endpoints', 'add', 'per_op_us', 100.0, None),
+            ('endpoints', 'new', 'error', None, 'KeyError: x'),
+        ])
+
+    def test_baseline_of_another_size_is_refused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            with open(path, 'w') as f:
+                json.dump({'options': {'rows': 100000, 'items': 100}, 'results': {}}, f)
+            with self.assertRaisesRegex(CommandError, r'--rows 50 \(baseline: 100000\)'):
+                call_command('benchmark', 'render_confirmation', compare=path, rows=50, stdout=io.StringIO())
+
+
+class GenerateDataTest(TestCase):
+    def generate(self, **options):
+        call_command('generate_data', users=60, seed=7, stdout=io.StringIO(), **options)
+        emails = sorted(Email.objects.filter(user__username__startswith='gen').values_list(
+            'user__username', 'address', 'is_verified', 'is_primary'))
+        confirmations = sorted(EmailConfirmation.objects.values_list('email__address', 'token_hash'))
+        return emails, confirmations
+
+    def test_deterministic_for_a_seed(self):
+        emails, confirmations = self.generate(chunk_size=7)
+        self.assertEqual(len({username for username, _a, _v, _p in emails}), 60)
+        self.assertTrue(confirmations)
+
+        get_user_model().objects.filter(username__startswith='gen').delete()
+        again = self.generate(chunk_size=60)
+        self.assertEqual([row for row in again[0]], emails)
+        self.assertEqual([address for address, _hash in again[1]], [address for address, _hash in confirmations])
+
+    def test_invariants(self):
+        self.generate(chunk_size=16, verified_ratio=0.5, pending_ratio=1)
+        for user in get_user_model().objects.filter(username__startswith='gen').prefetch_related('users'):
+            emails = list(user.users.all())
+            primary = [email for email in emails if email.is_primary]
+            self.assertLessEqual(len(primary), 1)
+            self.assertTrue(all(email.is_verified for email in primary))
+            self.assertEqual(user.email, primary[0].address if primary else '')
+        self.assertEqual(EmailConfirmation.objects.filter(email__is_verified=True).count(), 0)
+        self.assertEqual(EmailConfirmation.objects.count(), Email.objects.filter(is_verified=False).count())
+
+        with self.assertRaises(CommandError):
+            call_command('generate_data', users=1, stdout=io.StringIO())
+
+
+class StartupTest(SimpleTestCase):
+    @override_settings(STARTUP={'warmup': True, 'languages': ['en-us', 'de']})
+    def test_warmup(self):
+        confirmation_renderer.clear()
+        timings = startup.warmup()
+        self.assertEqual(list(timings), list(startup.steps))
+        self.assertEqual(set(confirmation_renderer._cache), {'en-us', 'de'})
+
+    def test_report(self):
+        out = io.StringIO()
+        call_command('startup_report', json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['modules'][0][0], settings.WSGI_APPLICATION.rpartition('.')[0])
+        self.assertEqual([name for name, _seconds in report['warmup']], list(startup.steps))
+        self.assertIn('django', dict(report['packages']))
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework.throttling import BaseThrottle
+
+from .managers import EmailManager
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token buckets kept in the shared cache, with a process-local fallback.
+
+    Each key holds ``(tokens, timestamp)``; a bucket holds up to ``capacity``
+    tokens and refills at ``capacity / period`` tokens per second. Updates are
+    read-modify-write, so concurrent processes may admit a few extra requests;
+    within a process a lock keeps them exact.
+    """
+
+    def __init__(self, alias=None):
+        self._alias = alias
+        self._cache = None
+        self._local = LocMemCache('myapp-throttle', {})
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            alias = self._alias or settings.REST_VIEW['throttle_cache']
+            self._cache = caches[alias] if alias in settings.CACHES else self._local
+        return self._cache
+
+    def consume(self, key, capacity, period, now=None):
+        """Take one token; returns ``(allowed, seconds until a token is available)``."""
+        allowed, waits = self.consume_all([(key, capacity, period)], now)
+        return allowed, waits[0]
+
+    def consume_all(self, buckets, now=None):
+        """Take one token from each of ``buckets``, ``[(key, capacity, period)]``, if all have one.
+
+        Returns ``(allowed, [seconds until each bucket has a token])``. A rejected request
+        takes nothing, so it does not drain the buckets that would have let it through.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            states = []
+            for key, capacity, period in buckets:
+                cache = self.cache
+                try:
+                    state = cache.get(key)
+                except Exception:
+                    logger.warning('Throttle cache unavailable, using the local fallback', exc_info=True)
+                    cache, state = self._local, self._local.get(key)
+                rate = capacity / float(period)
+                tokens, last = state if state is not None else (capacity, now)
+                states.append((cache, key, min(capacity, tokens + (now - last) * rate), rate, period))
+
+            allowed = all(tokens >= 1 for _cache, _key, tokens, _rate, _period in states)
+            waits = []
+            for cache, key, tokens, rate, period in states:
+                waits.append(0 if tokens >= 1 else (1 - tokens) / rate)
+                if allowed:
+                    tokens -= 1
+                try:
+                    cache.set(key, (tokens, now), period)
+                except Exception:
+                    self._local.set(key, (tokens, now), period)
+        return allowed, waits
+
+
+token_bucket = TokenBucket()
+
+
+@receiver(setting_changed)
+def reset_token_bucket_cache(setting, **kwargs):
+    if setting in ('REST_VIEW', 'CACHES'):
+        token_bucket._cache = None
+
+
+_durations = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'<requests>/<period>' as in DRF ('10/min', '3/hour') -> (capacity, period in seconds)."""
+    num, period = rate.split('/')
+    return int(num), _durations[period[0]]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """DRF throttle reading its limit from the view's ``token_buckets[scope]``.
+
+    Limits use DRF's rate syntax, e.g. ``{'user': '10/min', 'address': '3/min'}``;
+    a view without an entry for the scope is not throttled by it.
+    """
+    scope = None
+
+    def __init__(self):
+        self._wait = None
+
+    def get_bucket(self, request, view):
+        """``(cache key, capacity, period)`` of the request's bucket, or None if it is not throttled."""
+        rate = (getattr(view, 'token_buckets', None) or {}).get(self.scope)
+        if not rate:
+            return None
+        ident = self.get_bucket_ident(request, view)
+        if ident is None:
+            return None
+        capacity, period = parse_rate(rate)
+        return 'myapp:throttle:{}:{}:{}'.format(type(view).__name__, self.scope, ident), capacity, period
+
+    def allow_request(self, request, view):
+        bucket = self.get_bucket(request, view)
+        if bucket is None:
+            return True
+        allowed, self._wait = token_bucket.consume(*bucket)
+        return allowed
+
+    def get_bucket_ident(self, request, view):
+        raise NotImplementedError
+
+    def wait(self):
+        return self._wait
+
+
+class UserTokenBucketThrottle(TokenBucketThrottle):
+    scope = 'user'
+
+    def get_bucket_ident(self, request, view):
+        user = request.user
+        if user and user.is_authenticated:
+            return user.pk
+        # Anonymous callers share buckets by client address.
+        return self.get_ident(request)
+
+
+class AddressTokenBucketThrottle(TokenBucketThrottle):
+    """Buckets per target address, read from the view's ``throttle_address_param``."""
+    scope = 'address'
+
+    def get_bucket_ident(self, request, view):
+        name = getattr(view, 'throttle_address_param', 'email')
+        address = request.query_params.get(name)
+        if address is None and hasattr(request.data, 'get'):
+            address = request.data.get(name)
+        if not isinstance(address, str) or not address.strip():
+            return None
+        return EmailManager.normalize_address(address)
+
+
+def check_throttles(throttles, request, view):
+    """Waits of the ``throttles`` that reject the request; empty if it may go ahead.
+
+    Like DRF's APIView.check_throttles, except that token buckets are charged all or
+    nothing: a request one bucket turns away takes no token from the others.
+    """
+    waits, buckets = [], []
+    for throttle in throttles:
+        if isinstance(throttle, TokenBucketThrottle):
+            bucket = throttle.get_bucket(request, view)
+            if bucket is not None:
+                buckets.append(bucket)
+        elif not throttle.allow_request(request, view):
+            waits.append(throttle.wait())
+    if buckets:
+        allowed, bucket_waits = token_bucket.consume_all(buckets)
+        if not allowed:
+            waits.append(max(bucket_waits))
+    return waits
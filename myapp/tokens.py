@@ -0,0 +1,152 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signing import BadSignature, Signer
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.translation import ugettext as _
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+_signer = Signer(salt='myapp.tokens')
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def user_fingerprint(user):
+    """Short keyed hash of the user's password hash, as in PasswordResetTokenGenerator.
+
+    Changing the password or setting an unusable one changes it, which revokes every
+    token issued before.
+    """
+    return salted_hmac('myapp.tokens.fingerprint', user.get_session_auth_hash()).hexdigest()[:16]
+
+
+def make_token(user, purpose='api', now=None):
+    """A signed ``purpose.user_id.expires.fingerprint`` token for ``user``.
+
+    Valid API_TOKENS['max_age'][purpose] seconds, or until the user's fingerprint changes.
+    Returns ``{'token', 'purpose', 'expires'}`` with ``expires`` as a Unix timestamp.
+    """
+    now = time.time() if now is None else now
+    expires = int(now) + settings.API_TOKENS['max_age'][purpose]
+    return {
+        'token': _signer.sign('{}.{}.{}.{}'.format(purpose, user.pk, expires, user_fingerprint(user))),
+        'purpose': purpose,
+        'expires': expires,
+    }
+
+
+def check_token(token, purposes, now=None):
+    """``(purpose, user_id, fingerprint)`` of a valid, unexpired token for one of ``purposes``.
+
+    Raises InvalidToken. Only checks the signature and the clock: the fingerprint is
+    compared with the user's by VerifiedUserCache.load.
+    """
+    try:
+        purpose, user_id, expires, fingerprint = _signer.unsign(token).split('.')
+        user_id, expires = int(user_id), int(expires)
+    except (BadSignature, ValueError):
+        raise InvalidToken('Invalid token.')
+    if purpose not in purposes:
+        raise InvalidToken('Token not valid here.')
+    if expires <= (time.time() if now is None else now):
+        raise InvalidToken('Token expired.')
+    return purpose, user_id, fingerprint
+
+
+class VerifiedUserCache:
+    """Active users behind recently verified tokens, so most requests skip the user query.
+
+    Process-local LRU of at most API_TOKENS['user_cache_size'] users with their
+    fingerprints, each kept for API_TOKENS['user_cache_timeout'] seconds; a change to
+    a user made in another process shows up once its entry expires. A token whose
+    fingerprint differs from the cached one makes the user be read again before it is
+    turned away. Each request gets its own copy of the user.
+    """
+
+    def __init__(self):
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, now=None):
+        """``(user, fingerprint)`` if cached and fresh, else None."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            if entry[2] <= now:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+        return entry[0], entry[1]
+
+    def load(self, user_id, fingerprint, now=None):
+        """The user the token was issued to, if it still has ``fingerprint``; raises InvalidToken."""
+        entry = self.get(user_id, now)
+        if entry is None or not constant_time_compare(entry[1], fingerprint):
+            entry = self._fetch(user_id, now)
+        user, current = entry
+        if not constant_time_compare(current, fingerprint):
+            raise InvalidToken('Token revoked.')
+        return copy.copy(user)
+
+    def _fetch(self, user_id, now):
+        try:
+            user = get_user_model()._default_manager.get(pk=user_id, is_active=True)
+        except get_user_model().DoesNotExist:
+            self.discard(user_id)
+            raise InvalidToken('No such user.')
+        entry = (user, user_fingerprint(user))
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._users[user_id] = entry + (now + settings.API_TOKENS['user_cache_timeout'],)
+            self._users.move_to_end(user_id)
+            while len(self._users) > settings.API_TOKENS['user_cache_size']:
+                self._users.popitem(last=False)
+        return entry
+
+    def discard(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+verified_users = VerifiedUserCache()
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """``Authorization: Bearer <token>`` with tokens from make_token.
+
+    The token must be for one of the view's ``token_purposes``. Requests without a
+    bearer token are left to the next authentication class.
+    """
+    keyword = b'bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword:
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed(_('Invalid token header.'))
+
+        view = request.parser_context.get('view')
+        purposes = getattr(view, 'token_purposes', ('api',))
+        try:
+            _purpose, user_id, fingerprint = check_token(auth[1].decode('latin-1'), purposes)
+            user = verified_users.load(user_id, fingerprint)
+        except InvalidToken as e:
+            raise exceptions.AuthenticationFailed(str(e))
+        return user, auth[1]
+
+    def authenticate_header(self, request):
+        return 'Bearer'
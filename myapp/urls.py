@@ -1,7 +1,7 @@
 from django.urls import path
 
-from .views import (EmailList, EmailDelete, EmailAdd, EmailSendConfirmation,
-                    EmailConfirm, EmailSetPrimary, Index)
+from .views import (ApiToken, EmailList, EmailDelete, EmailAdd, EmailSendConfirmation,
+                    EmailConfirm, EmailSetPrimary, EmailBatch, Index, metrics)
 
 app_name = "myapp"
 
@@ -12,7 +12,10 @@ urlpatterns = [
     path('send_confirmation/', EmailSendConfirmation.as_view()),
     path('confirm_primary/', EmailConfirm.as_view()),
     path('set_primary/', EmailSetPrimary.as_view()),
+    path('batch/', EmailBatch.as_view()),
     path('index/', Index.index),
+    path('metrics/', metrics),
+    path('token/', ApiToken.as_view()),
 ]
 
 
@@ -1,18 +1,32 @@
-from django.http import HttpResponse
+import base64
+import binascii
+import hashlib
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseForbidden
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.validators import ValidationError
+from django.db import IntegrityError, transaction
 from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string
-from django.utils import translation
 from django.utils.translation import ugettext as _
-#  from user_agents import parse
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication
+try:
+    from user_agents import parse
+except ImportError:  # optional dependency
+    parse = None
 
+from .caching import email_list_cache, primary_email_cache
+from .metrics import request_metrics
 from .models import Email, EmailConfirmation
-from .ownView import RestView, StatusCode
+from .ownView import (AsyncRestView, EmailParam, IntParam, InvalidArgumentError, RestView, StatusCode,
+                      StringParam, parse_email)
 from .datetime import Datetime
 
 
-from .serializers import EmailSerializer
+from .serializers import EmailReadSerializer, EmailSerializer
+
+logger = logging.getLogger(__name__)
 
 
 class Index:
@@ -20,14 +34,109 @@ class Index:
         return  HttpResponse('hello')
 
 
+def metrics(request):
+    """RestView metrics for a local Prometheus scrape."""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS['allowed_ips']:
+        return HttpResponseForbidden()
+    return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ApiToken(RestView):
+    """Issues a signed API token for the user, to send as ``Authorization: Bearer <token>``.
+
+    Needs a session or basic auth: a bearer token cannot mint its own successor.
+    """
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    query_budget = 0
+    token_buckets = {'user': '10/min'}
+
+    def _post(self):
+        return self.success(self._generate_token('api'))
+
+
 class EmailList(RestView):
+    """The user's emails.
+
+    Without paging parameters the whole list is returned (and cached). With ``cursor``,
+    ``page_size`` or ``fields`` the result is ``{"results": [...], "next": <cursor>}``: a
+    keyset page ordered by id, projected to the requested subset of EmailSerializer fields.
+    """
+    serializer_class = EmailReadSerializer
+    read_only = True
+    query_budget = 1
+    page_size = 100
+    max_page_size = 1000
+
+    def get_etag(self):
+        etag = 'emails-{}'.format(email_list_cache.version(self._user.pk))
+        if self._is_paged():
+            query = self._request.META.get('QUERY_STRING', '')
+            etag += '-' + hashlib.md5(query.encode('utf-8')).hexdigest()[:12]
+        return etag
+
     def _get(self):
-        return self.success(EmailSerializer(Email.objects.filter(user=self._user).all(), many=True).data)
+        if self._is_paged():
+            return self.success(self._page())
+        return self.success(email_list_cache.get(self._user.pk, self._fill))
+
+    def _fill(self):
+        return list(self.serializer_class(Email.objects.filter(user=self._user).order_by('id'), many=True).data)
+
+    def _is_paged(self):
+        params = self._request.query_params
+        return 'cursor' in params or 'page_size' in params or 'fields' in params
+
+    def _page(self):
+        page_size = self.get_int_param('page_size', "Please enter a valid page size",
+                                       default=self.page_size, required=False)
+        if not 0 < page_size <= self.max_page_size:
+            raise InvalidArgumentError("Please enter a valid page size")
+        after = self._decode_cursor(self.get_string_param('cursor', "Please enter a valid cursor", required=False))
+        fields = self._requested_fields()
+
+        # id is always fetched to build the next cursor, even when not requested.
+        columns = fields if 'id' in fields else ('id',) + fields
+        rows = list(Email.objects.filter(user=self._user, id__gt=after).order_by('id')
+                    .values(*columns)[:page_size + 1])
+        next_cursor = self._encode_cursor(rows[page_size - 1]['id']) if len(rows) > page_size else None
+        rows = rows[:page_size]
+        if 'id' not in fields:
+            for row in rows:
+                del row['id']
+        return {'results': rows, 'next': next_cursor}
+
+    def _requested_fields(self):
+        available = EmailSerializer.Meta.fields
+        value = self.get_string_param('fields', "Please enter valid fields", required=False)
+        if not value:
+            return available
+        requested = set(name.strip() for name in value.split(',') if name.strip())
+        unknown = requested.difference(available)
+        if unknown or not requested:
+            raise InvalidArgumentError("Unknown fields: {}".format(', '.join(sorted(unknown))) if unknown
+                                       else "Please enter valid fields")
+        return tuple(name for name in available if name in requested)
+
+    @staticmethod
+    def _encode_cursor(last_id):
+        return base64.urlsafe_b64encode(str(last_id).encode('ascii')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        if not cursor:
+            return 0
+        try:
+            return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii'))
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            raise InvalidArgumentError("Please enter a valid cursor")
 
 
 class EmailDelete(RestView):
+    param_schema = {'id': IntParam()}
+    query_budget = 3
+
     def _delete(self):
-        email_id = self.get_int_param('id', required=True)
+        email_id = self.params['id']
         try:
             email = Email.objects.get(pk=email_id, user=self._user)
         except Email.DoesNotExist:
@@ -41,54 +150,192 @@ class EmailDelete(RestView):
 
 
 class EmailAdd(RestView):
+    param_schema = {'email': EmailParam()}
+    query_budget = 1
+
     def _post(self):
-        email_address = self.get_email_param('email', required=True)
-        if Email.objects.filter(address__iexact=email_address).exists():
+        email_address = self.params['email']
+        try:
+            with transaction.atomic():
+                Email.objects.create(user=self._user, address=email_address, is_verified=False, is_primary=False)
+        except IntegrityError:
             return self.error(StatusCode.ERROR_CONFLICT, _("Email already in use."))
-        Email.objects.get_or_create(user=self._user, address=email_address,
-                                    defaults={'is_verified': False, 'is_primary': False})
         return self.success({}, _("Email successfully added."))
 
 
+class EmailBatch(RestView):
+    """Apply many add / remove / set_label operations in one request.
+
+    ``operations`` is a list of ``{"op": "add", "email": ...}``, ``{"op": "remove", "id": ...}``
+    or ``{"op": "set_label", "id": ..., "label": ...}``. The batch is validated as a whole with
+    one lookup per kind, then applied in one transaction; each operation gets its own result.
+    """
+    query_budget = 9
+    max_operations = 1000
+
+    def _post(self):
+        operations = self.get_json_param('operations', list, "Please enter a list of operations")
+        if len(operations) > self.max_operations:
+            return self.error(StatusCode.ERROR_NOT_ACCEPTABLE,
+                              _("At most %d operations per request.") % self.max_operations)
+
+        results = [None] * len(operations)
+        adds, removes, labels = self._validate(operations, results)
+
+        while True:
+            try:
+                with transaction.atomic():
+                    self._apply(adds, removes, labels, results)
+                break
+            except IntegrityError:
+                # An address was taken after _validate: fail just those adds and apply the rest.
+                if not self._reject_taken(adds, results):
+                    return self.error(StatusCode.ERROR_CONFLICT, _("Email already in use."))
+        # bulk_create and bulk_update send no signals.
+        email_list_cache.invalidate(self._user.pk)
+        primary_email_cache.invalidate(self._user.pk)
+
+        added = {}
+        if adds:
+            added = {row['address']: row for row in EmailReadSerializer(
+                Email.objects.filter(user=self._user, address__in=[a for a, _n in adds.values()]), many=True).data}
+        for index, (address, _normalized) in adds.items():
+            results[index] = self._result(index, StatusCode.SUCCESS_CREATED, _("Email successfully added."),
+                                          added.get(address))
+        for email_id, index in removes.items():
+            results[index] = self._result(index, StatusCode.SUCCESS, _("Email successfully removed"))
+        for index, _label in labels.values():
+            results[index] = self._result(index, StatusCode.SUCCESS, _("Label successfully updated."))
+        return self.success(results)
+
+    def _apply(self, adds, removes, labels, results):
+        Email.objects.bulk_create([
+            Email(user=self._user, address=address, address_normalized=normalized,
+                  is_verified=False, is_primary=False)
+            for address, normalized in adds.values()
+        ])
+        if labels:
+            emails = [Email(pk=email_id, label=label) for email_id, (index, label) in labels.items()]
+            Email.objects.bulk_update(emails, ['label'])
+        if removes:
+            # Checked again under lock: an email may have been removed or made primary since _validate.
+            current = dict(Email.objects.select_for_update().filter(user=self._user, pk__in=list(removes))
+                           .values_list('pk', 'is_primary'))
+            for email_id, index in list(removes.items()):
+                if email_id not in current:
+                    results[index] = self._result(index, StatusCode.ERROR_NOT_FOUND,
+                                                  _("Email not associated with account"))
+                    del removes[email_id]
+                elif current[email_id]:
+                    results[index] = self._result(index, StatusCode.ERROR_NOT_ALLOWED,
+                                                  _("Cannot remove account primary email"))
+                    del removes[email_id]
+            Email.objects.filter(user=self._user, pk__in=list(removes), is_primary=False).delete()
+
+    def _reject_taken(self, adds, results):
+        """Fail the adds whose address is already in use; returns whether there were any."""
+        by_normalized = {normalized: index for index, (address, normalized) in adds.items()}
+        taken = list(Email.objects.filter(address_normalized__in=list(by_normalized))
+                     .values_list('address_normalized', flat=True))
+        for normalized in taken:
+            index = by_normalized[normalized]
+            results[index] = self._result(index, StatusCode.ERROR_CONFLICT, _("Email already in use."))
+            del adds[index]
+        return bool(taken)
+
+    def _validate(self, operations, results):
+        adds, removes, labels = {}, {}, {}
+        by_id = {}
+        for index, operation in enumerate(operations):
+            op = operation.get('op') if isinstance(operation, dict) else None
+            if op == 'add':
+                try:
+                    address = parse_email(operation.get('email'))
+                except (ValidationError, AttributeError, TypeError, ValueError):
+                    results[index] = self._result(index, StatusCode.ERROR, _("Please enter a valid email"))
+                    continue
+                adds[index] = (address, Email.objects.normalize_address(address))
+            elif op in ('remove', 'set_label'):
+                email_id = operation.get('id')
+                label = operation.get('label')
+                if not isinstance(email_id, int) or isinstance(email_id, bool):
+                    results[index] = self._result(index, StatusCode.ERROR, _("Please enter a valid integer"))
+                elif op == 'set_label' and not (label is None or isinstance(label, str) and len(label) <= 255):
+                    results[index] = self._result(index, StatusCode.ERROR, _("Please enter a valid label"))
+                else:
+                    by_id.setdefault(email_id, []).append(index)
+            else:
+                results[index] = self._result(index, StatusCode.ERROR, _("Unknown operation."))
+
+        # Addresses: one query for those already in use, plus duplicates inside the batch.
+        seen = {}
+        for index, (address, normalized) in list(adds.items()):
+            if normalized in seen:
+                results[index] = self._result(index, StatusCode.ERROR_CONFLICT, _("Email already in use."))
+                del adds[index]
+            seen[normalized] = index
+        self._reject_taken(adds, results)
+
+        # Ids: one query for ownership and primary flags; an id may only be used once per batch.
+        owned = dict(Email.objects.filter(user=self._user, pk__in=list(by_id)).values_list('pk', 'is_primary'))
+        for email_id, indexes in by_id.items():
+            if len(indexes) > 1:
+                for index in indexes:
+                    results[index] = self._result(index, StatusCode.ERROR_CONFLICT,
+                                                  _("Email used by more than one operation."))
+                continue
+            index = indexes[0]
+            operation = operations[index]
+            if email_id not in owned:
+                results[index] = self._result(index, StatusCode.ERROR_NOT_FOUND,
+                                              _("Email not associated with account"))
+            elif operation['op'] == 'remove':
+                if owned[email_id]:
+                    results[index] = self._result(index, StatusCode.ERROR_NOT_ALLOWED,
+                                                  _("Cannot remove account primary email"))
+                else:
+                    removes[email_id] = index
+            else:
+                labels[email_id] = (index, operation.get('label'))
+        return adds, removes, labels
+
+    @staticmethod
+    def _result(index, status_code, msg, obj=None):
+        result = {'index': index, 'status': StatusCode.names[status_code], 'message': msg}
+        if obj is not None:
+            result['object'] = obj
+        return result
+
+
 #  class EmailSendConfirmation(TokenBase):
-class EmailSendConfirmation(RestView):
-    def _get(self):
-        email_address = self.get_email_param('email', required=True)
+class EmailSendConfirmation(AsyncRestView):
+    """Creates a confirmation code and queues the email carrying it.
+
+    Delivery is left to the outbox workers, and the database work runs off the event
+    loop, so under ASGI a slow database or mail relay never holds up other requests.
+    """
+    param_schema = {'email': EmailParam()}
+    query_budget = 4
+    token_buckets = {'user': '10/min', 'address': '3/min'}
+
+    async def _get(self):
+        email_address = self.params['email']
         try:
-            email = Email.objects.get(user=self._user, address__iexact=email_address)
+            email = await sync_to_async(Email.objects.get)(
+                user=self._user, address_normalized=Email.objects.normalize_address(email_address))
         except Email.DoesNotExist:
             return self.error(StatusCode.ERROR_NOT_FOUND, _("Email not associated with any account."))
 
         if email.is_verified:
             return self.error(StatusCode.ERROR_NOT_ALLOWED, _("Email address already confirmed."))
 
-        email.confirmation = email.create_confirmation(settings.WEBSITE['confirmation_digits'])
-        email.confirmation.sent = Datetime.utcnow()
-        email.confirmation.save()
-
-        user_agent = parse(self._request.META.get('HTTP_USER_AGENT', ''))
+        user_agent = parse(self._request.META.get('HTTP_USER_AGENT', '')) if parse else None
         context = {
-            'website_url': settings.WEBSITE['url'],
-            'support_url': settings.WEBSITE['support_url'],
-            'first_name': self._user.first_name,
-            'token': email.confirmation.token,
-            'operating_system': user_agent.os.family,
-            'browser_name': user_agent.browser.family,
+            'operating_system': user_agent.os.family if user_agent else '',
+            'browser_name': user_agent.browser.family if user_agent else '',
         }
-
-        translation.activate(self._user.language)
-        subject = render_to_string('emails/confirm_subject.txt', context)
-        text = render_to_string('emails/confirm.txt', context)
-        html = render_to_string('emails/confirm.html', context)
-        from_email = settings.WEBSITE['support_email']
-        send_mail(
-            subject=subject.replace('\n', ''),
-            message=text,
-            from_email=from_email,
-            recipient_list=(email.address,),
-            html_message=html,
-        )
-        logger.info('Sent email confirmation email to user %d (%s)', self._user.id, email.address)
+        await sync_to_async(email.send_confirmation)(self._user, context)
+        logger.info('Queued email confirmation email to user %d (%s)', self._user.id, email.address)
 
         api_token = self._generate_token('email_confirm')['token']
 
@@ -124,10 +371,13 @@ class EmailSendConfirmation(RestView):
         }
         return self.success(results, _("Email confirmation sent successfully."), status_code=StatusCode.SUCCESS_CONFIRM)
 
-
 class EmailConfirm(RestView):
+    param_schema = {'token': StringParam()}
+    query_budget = 4
+    token_purposes = ('api', 'email_confirm')
+
     def _get(self):
-        token = self.get_string_param('token', required=True).strip()
+        token = self.params['token'].strip()
         if not token:
             return self.error(StatusCode.ERROR_NOT_FOUND, _('Please enter confirmation code.'))
 
@@ -143,8 +393,11 @@ class EmailConfirm(RestView):
 
 
 class EmailSetPrimary(RestView):
+    param_schema = {'id': IntParam()}
+    query_budget = 4
+
     def _post(self):
-        email_id = self.get_int_param('id', required=True)
+        email_id = self.params['id']
         try:
             email = Email.objects.get(user=self._user, pk=email_id)
         except Email.DoesNotExist:
@@ -154,4 +407,4 @@ class EmailSetPrimary(RestView):
             return self.error(StatusCode.ERROR_NOT_ALLOWED, _("Cannot set primary email to unverified address."))
         email.set_as_primary()
 
-        return self.success(EmailSerializer(email), _("Successfully set account primary email address"))
+        return self.success(EmailSerializer(email).data, _("Successfully set account primary email address"))